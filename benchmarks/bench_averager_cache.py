@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+"""
+Benchmark RadialAverager startup on a CSPAD-sized detector: building it
+from the q-map and mask, against reading the precomputed arrays from an
+averager cache file (including validating it by content hash).
+
+usage:
+python benchmarks/bench_averager_cache.py [n_bins]
+"""
+
+import os
+import sys
+import time
+import tempfile
+
+import numpy as np
+
+from timescans import algorithms
+from bench_radial import fake_detector
+
+
+def main(n_bins=201):
+
+    q_values, mask = fake_detector()
+    image = np.random.RandomState(2).exponential(50.0, size=q_values.shape)
+    path = os.path.join(tempfile.mkdtemp(), 'averager.h5')
+
+    try:
+        t0 = time.time()
+        ra = algorithms.RadialAverager(q_values, mask, n_bins=n_bins)
+        t_build = time.time() - t0
+
+        content_hash = algorithms.geometry_hash(q_values, mask, n_bins)
+        algorithms.save_averager_cache(path, ra.to_arrays(), content_hash)
+
+        t0 = time.time()
+        content_hash = algorithms.geometry_hash(q_values, mask, n_bins)
+        t_hash = time.time() - t0
+
+        t0 = time.time()
+        arrays = algorithms.load_averager_cache(path, content_hash)
+        cached = algorithms.RadialAverager.from_arrays(arrays)
+        t_load = time.time() - t0
+    finally:
+        os.remove(path)
+        os.rmdir(os.path.dirname(path))
+
+    print('%d pixels (%d unmasked), %d bins' % (mask.size, ra.n_pixels, n_bins))
+    print('build          : %8.3f s' % t_build)
+    print('hash           : %8.3f s' % t_hash)
+    print('cache load     : %8.3f s' % t_load)
+    print('same result: %s' % np.array_equal(ra(image), cached(image)))
+
+    return
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
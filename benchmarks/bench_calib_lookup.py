@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+"""
+Benchmark psconst.find_calib_file lookups in a calib directory with many
+run ranges, against a listdir + parse scan per call.
+
+usage:
+python benchmarks/bench_calib_lookup.py [n_files] [n_lookups]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+
+import psconst
+
+
+def find_calib_file_scan(basepath, run):
+    """
+    A full directory scan per lookup, the way find_calib_file used to work
+    (without its early IOError), for reference.
+    """
+
+    nearest = None
+    for fn in os.listdir(basepath):
+        start, end = os.path.splitext(fn)[0].split('-')
+        start = int(start)
+        end = float('inf') if (end == 'end') else int(end)
+        if (start <= run) and (run <= end):
+            if (nearest is None) or (start > nearest[0]):
+                nearest = (start, fn)
+
+    return os.path.join(basepath, nearest[1])
+
+
+def main(n_files=2000, n_lookups=1000):
+
+    calib_dir = tempfile.mkdtemp()
+    basepath = os.path.join(calib_dir, 'timetool', 'src')
+    os.makedirs(basepath)
+
+    rs = np.random.RandomState(0)
+    starts = np.sort(rs.choice(np.arange(1, 10 * n_files), n_files, replace=False))
+    for i, s in enumerate(starts):
+        end = 'end' if (i % 10 == 0) else s + rs.randint(0, 50)
+        open(os.path.join(basepath, '%d-%s.h5' % (s, end)), 'w').close()
+
+    runs = rs.randint(starts[0], 10 * n_files, n_lookups)
+
+    try:
+        t0 = time.time()
+        ref = [ find_calib_file_scan(basepath, r) for r in runs ]
+        t_scan = time.time() - t0
+
+        t0 = time.time()
+        new = [ psconst.find_calib_file(calib_dir, 'timetool', 'src', r) for r in runs ]
+        t_index = time.time() - t0
+    finally:
+        shutil.rmtree(calib_dir)
+
+    print('%d files, %d lookups' % (n_files, n_lookups))
+    print('scan   : %8.3f s' % t_scan)
+    print('index  : %8.3f s (including the first build)' % t_index)
+    print('same result: %s' % (ref == new))
+
+    return
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
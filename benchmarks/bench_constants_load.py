@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+"""
+Benchmark psconst.load on a store holding detector-sized arrays (mask,
+q-map, gain), reading a single small coefficient array: eager (lazy=False)
+vs. the lazy, memory-mapped view.
+
+usage:
+python benchmarks/bench_constants_load.py [n_pixels]
+"""
+
+import os
+import sys
+import time
+import tempfile
+
+import numpy as np
+
+import psconst
+
+
+def main(n_pixels=2296960):
+
+    path = os.path.join(tempfile.mkdtemp(), 'store.h5')
+    psconst.save(path, { 'fit_coeff' : np.array([1.0e-9, 2.0e-6, -1.0e-3]),
+                         'mask'      : np.ones(n_pixels, dtype=np.int32),
+                         'q_map'     : np.linspace(0.0, 4.0, n_pixels),
+                         'gain'      : np.ones(n_pixels) })
+
+    try:
+        t0 = time.time()
+        ref = psconst.load(path, lazy=False)['fit_coeff']
+        t_eager = time.time() - t0
+
+        t0 = time.time()
+        with psconst.load(path) as c:
+            new = c['fit_coeff']
+        t_lazy = time.time() - t0
+
+        t0 = time.time()
+        with psconst.load(path) as c:
+            q_sum = c['q_map'].sum()
+        t_mmap = time.time() - t0
+    finally:
+        os.remove(path)
+        os.rmdir(os.path.dirname(path))
+
+    print('%d pixel arrays' % n_pixels)
+    print('eager load          : %8.4f s' % t_eager)
+    print('lazy, one key       : %8.4f s' % t_lazy)
+    print('lazy, mmap + reduce : %8.4f s' % t_mmap)
+    print('same result: %s' % np.all(ref == new))
+
+    return
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
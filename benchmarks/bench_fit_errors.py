@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+"""
+Benchmark calibration.fit_errors on 10^6 points against the original
+per-bin loop.
+
+usage:
+python benchmarks/bench_fit_errors.py [n_points]
+"""
+
+import sys
+import time
+
+import numpy as np
+
+from timescans import calibration
+
+
+def fit_errors_loop(x, y, y_hat, bin_size):
+    """
+    The original O(n_bins x n_points) implementation, for reference.
+    """
+
+    ssq = lambda x : np.sum(np.square(x))
+
+    ssres = ssq(y - y_hat)
+    sstot = ssq(y - np.mean(y))
+    r_sq = 1.0 - ssres / sstot
+
+    bins = np.arange(x.min(), x.max()+bin_size*2, bin_size)
+    assign = np.digitize(x, bins)
+    uq = np.unique(assign)
+    rmes = np.zeros((len(uq), 3))
+
+    for i,u in enumerate(uq):
+        idx = (assign == u)
+        rmes[i,0] = np.mean(x[idx])
+        rmes[i,1] = np.mean(y_hat[idx])
+        rmes[i,2] = np.sqrt(ssq( y[idx] - y_hat[idx] ) / np.sum(idx) )
+
+    return r_sq, rmes
+
+
+def main(n_points=1000000, bin_size=5):
+
+    rs = np.random.RandomState(0)
+    x = rs.uniform(200, 800, n_points)
+    y_hat = 1.0e-6 * x**2 + 2.0e-3 * x - 1.0
+    y = y_hat + rs.normal(0.0, 0.02, n_points)
+    w = rs.uniform(0.5, 1.5, n_points)
+
+    t0 = time.time()
+    ref = fit_errors_loop(x, y, y_hat, bin_size)
+    t_loop = time.time() - t0
+
+    t0 = time.time()
+    new = calibration.fit_errors(x, y, y_hat, bin_size)
+    t_new = time.time() - t0
+
+    t0 = time.time()
+    calibration.fit_errors(x, y, y_hat, bin_size, weights=w)
+    t_weighted = time.time() - t0
+
+    print('%d points, %d bins' % (n_points, ref[1].shape[0]))
+    print('loop     : %8.3f s' % t_loop)
+    print('bincount : %8.3f s' % t_new)
+    print('weighted : %8.3f s' % t_weighted)
+    print('max abs difference: %g (R^2), %g (rmes)' % (abs(ref[0] - new[0]),
+                                                      np.abs(ref[1] - new[1]).max()))
+
+    return
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
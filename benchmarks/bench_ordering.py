@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+"""
+Compare timepoint orderings (timescans.scheduling) for a randomized scan:
+expected TT stage travel and scan time, the simulated scan time (see
+bench_scan.py), and how well the order decorrelates the timepoints from a
+slow linear drift (|correlation| between step number and delay, mean
+over 50 random orders, 0 is best). Without a `repeats` argument both a
+single repeat (the scan_times default) and 3 repeats are run.
+
+usage:
+python benchmarks/bench_ordering.py [n_times] [repeats] [time_scale]
+"""
+
+import sys
+
+import numpy as np
+
+from timescans import scheduling
+from bench_scan import sim_timescaner, measure
+
+
+def drift_r(times, repeats, method, n_seeds=50):
+    """ mean |corr(step, delay)| of `method` orders over `n_seeds` seeds """
+    if method is None:
+        order = np.tile(times, repeats)
+        return abs(np.corrcoef(np.arange(order.shape[0]), order)[0,1])
+    r = []
+    for seed in range(n_seeds):
+        order = scheduling.order_timepoints(times, repeats=repeats,
+                                            method=method, random_state=seed)
+        r.append(abs(np.corrcoef(np.arange(order.shape[0]), order)[0,1]))
+    return np.mean(r)
+
+
+def main(n_times=21, repeats=None, time_scale=20.0):
+
+    tt, sim = sim_timescaner(time_scale)
+    # the stage velocity/acceleration come from the (simulated) motor record
+    tt.cycle_overhead = 2.0 * sim.transition_time # begin + end
+
+    times_in_ns = np.linspace(-0.002, 0.002, n_times)
+    nevents = 120
+
+    # scan_times defaults to a single repeat, which is the hardest case
+    # for decorrelation
+    for n_repeats in ([1, 3] if repeats is None else [repeats]):
+
+        print('%d timepoints x %d repeats, %d events each' % (n_times, n_repeats, nevents))
+        print('%-10s %10s %12s %12s %10s' % ('ordering', 'travel mm', 'expected s',
+                                            'simulated s', '|drift r|'))
+
+        for method in [None] + list(scheduling.ORDERINGS):
+
+            if method is None:
+                order = np.tile(times_in_ns, n_repeats)
+            else:
+                order = scheduling.order_timepoints(times_in_ns, repeats=n_repeats,
+                                                    method=method, random_state=0)
+            estimate = tt.estimate_scan(order, nevents)
+
+            # order is fixed here, so scan it as given
+            _, wall, _ = measure(None, tt, sim, tt.scan_times, order,
+                                 nevents_per_timestep=nevents)
+
+            print('%-10s %10.2f %12.1f %12.1f %10.3f' % (method or 'sequential',
+                                                        estimate['travel'],
+                                                        estimate['total_time'],
+                                                        wall,
+                                                        drift_r(times_in_ns, n_repeats, method)))
+        print('')
+
+    return
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(*([int(a) for a in args[:2]] + [float(a) for a in args[2:]]))
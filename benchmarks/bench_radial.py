@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the RadialAverager on CSPAD-sized (32, 185, 388) frames.
+
+Compares frames/sec for the original full-detector implementation
+(`baseline_average`: mask multiply and bincount over every pixel) with the
+per-frame path, `ra(image)`, `ra.batch(images)` (a loop over the same
+per-frame path writing into one output array, so expect about the same
+rate) and the threaded per-frame path.
+
+usage:
+python benchmarks/bench_radial.py [n_frames] [block_size] [n_threads]
+"""
+
+import sys
+import time
+
+import numpy as np
+
+from timescans import algorithms
+
+
+CSPAD_SHAPE = (32, 185, 388)
+N_BINS      = 201
+
+
+def fake_detector(shape=CSPAD_SHAPE, masked_fraction=0.2, seed=0):
+    """
+    Make a fake q-map (distance from a beam center) and random mask.
+    """
+    rs = np.random.RandomState(seed)
+    q_values = np.sqrt(np.sum(np.square(np.indices(shape, dtype=np.float64)
+                              - np.array(shape).reshape(3,1,1,1) / 2.0), axis=0))
+    mask = (rs.rand(*shape) > masked_fraction).astype(np.int32)
+    return q_values, mask
+
+
+def fake_frames(n_frames, shape=CSPAD_SHAPE, seed=1):
+    rs = np.random.RandomState(seed)
+    return rs.exponential(50.0, size=(n_frames,) + shape)
+
+
+class BaselineAverager(object):
+    """
+    The RadialAverager as it was before the compact pixel index, threads
+    and fused corrections, kept as the reference to measure them against.
+    """
+
+    def __init__(self, q_values, mask, n_bins):
+        self.mask = mask
+        self.n_bins = n_bins
+        q_range = q_values.max() - q_values.min()
+        bin_width = q_range / (float(n_bins) - 1)
+        self._bin_assignments = np.floor( (q_values - q_values.min()) / bin_width ).astype(np.int32)
+        # minlength (here and below): the original assumed the last bin is
+        # never empty
+        self._normalization_array = (np.bincount( self._bin_assignments.flatten(),
+                                                  weights=self.mask.flatten(),
+                                                  minlength=n_bins ) \
+                                    + 1e-100).astype(np.float64)
+
+    def __call__(self, image):
+        weights = image.flatten() * self.mask.flatten()
+        bin_values = np.bincount(self._bin_assignments.flatten(), weights=weights,
+                                 minlength=self.n_bins)
+        bin_values /= self._normalization_array
+        return bin_values
+
+
+def frames_per_sec(fxn, n_frames):
+    t0 = time.time()
+    fxn()
+    return n_frames / (time.time() - t0)
+
+
+def main(n_frames=32, block_size=16, n_threads=4):
+
+    q_values, mask = fake_detector()
+    ra = algorithms.RadialAverager(q_values, mask, n_bins=N_BINS)
+    frames = fake_frames(n_frames)
+
+    ra_baseline = BaselineAverager(q_values, mask, N_BINS)
+    def baseline():
+        for i in range(n_frames):
+            ra_baseline(frames[i])
+
+    def per_frame():
+        for i in range(n_frames):
+            ra(frames[i])
+
+    out = np.empty((block_size, N_BINS))
+    def batched():
+        for i in range(0, n_frames - block_size + 1, block_size):
+            ra.batch(frames[i:i+block_size], out=out)
+
+    ra_threaded = algorithms.RadialAverager(q_values, mask, n_bins=N_BINS,
+                                            n_threads=n_threads)
+    def threaded():
+        for i in range(n_frames):
+            ra_threaded(frames[i])
+
+    ref = np.array([ ra(f) for f in frames[:block_size] ])
+    err = np.abs(ra.batch(frames[:block_size]) - ref).max()
+    baseline_err = np.abs(np.array([ ra_baseline(f) for f in frames[:block_size] ]) - ref).max()
+
+    print('%d frames of %s, %d bins' % (n_frames, str(CSPAD_SHAPE), N_BINS))
+    print('baseline  : %8.2f frames/sec' % frames_per_sec(baseline, n_frames))
+    print('per-frame : %8.2f frames/sec' % frames_per_sec(per_frame, n_frames))
+    print('batch loop (%d): %8.2f frames/sec' % (block_size, frames_per_sec(batched, n_frames)))
+    print('threads (%d): %7.2f frames/sec' % (n_threads, frames_per_sec(threaded, n_frames)))
+    print('max abs difference: %g (batch), %g (baseline)' % (err, baseline_err))
+
+    ra_threaded.close()
+
+    return
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+"""
+Benchmark Timescaner scans against the simulated EPICS/DAQ backend
+(timescans.simulation): timesteps per minute, dead-time fraction (time not
+spent taking data) and total wall time, all in simulated seconds.
+
+Each scan is run sequentially (move, settle, acquire) and pipelined
+(pipelined=True, motion overlapped with the end of each calib cycle).
+
+usage:
+python benchmarks/bench_scan.py [time_scale] [event_rate] [transition_time]
+"""
+
+import sys
+import time
+import cStringIO
+
+import numpy as np
+
+from timescans import base
+from timescans import simulation
+
+
+CXI_PVS = ('cxi-daq', 4,
+           'LAS:FS5:VIT:FS_TGT_TIME_DIAL',   # laser delay, ns
+           'CXI:LAS:MMN:04',                 # TT stage, mm
+           'LAS:FS5:VIT:FS_TGT_TIME_OFFSET',
+           'LAS:FS5:VIT:PHASE_LOCKED')
+
+# rough stage performance
+LASER_DELAY_MOTOR = dict(velocity=0.01, acceleration=0.05, noise=0.0)  # ns/s, ns/s^2
+TT_STAGE_MOTOR    = dict(velocity=1.0, acceleration=5.0, noise=1.0e-4) # mm/s, mm/s^2
+
+
+def sim_timescaner(time_scale=20.0, event_rate=120.0, transition_time=0.2):
+    """
+    A Timescaner on a SimBackend with CXI-like PV names and stages.
+    """
+    sim = simulation.SimBackend(time_scale=time_scale, event_rate=event_rate,
+                                transition_time=transition_time)
+    sim.add_motor(CXI_PVS[2], seed=0, **LASER_DELAY_MOTOR)
+    sim.add_motor(CXI_PVS[3], seed=1, **TT_STAGE_MOTOR)
+    # the simulated laser delay is a motor record as well, watch its readback
+    tt = base.Timescaner(*CXI_PVS, laser_delay_readback_pv_name=CXI_PVS[2] + '.RBV',
+                         backend=sim)
+    return tt, sim
+
+
+def measure(name, tt, sim, scan, *args, **kwargs):
+    """
+    Run `scan(*args, **kwargs)` quietly, and print its throughput (unless
+    `name` is `None`).
+    """
+
+    daq = tt.daq
+    n0, acq0, t0 = len(daq.cycles), daq.acquire_time, sim.now()
+
+    stdout, sys.stdout = sys.stdout, cStringIO.StringIO()
+    try:
+        scan(*args, **kwargs)
+    finally:
+        sys.stdout = stdout
+
+    n_steps = len(daq.cycles) - n0
+    wall = sim.now() - t0
+    dead = 1.0 - (daq.acquire_time - acq0) / wall
+
+    if name is None:
+        return n_steps, wall, dead
+    print('%-36s %6d steps  %8.1f steps/min  dead time %5.1f%%  wall %8.1f s'
+          % (name, n_steps, n_steps / wall * 60.0, dead * 100.0, wall))
+
+    return n_steps, wall, dead
+
+
+def main(time_scale=20.0, event_rate=120.0, transition_time=0.2):
+
+    tt, sim = sim_timescaner(time_scale, event_rate, transition_time)
+    times_in_ns = np.linspace(-0.001, 0.001, 11)
+
+    print('simulated event rate %.0f Hz, %.2f s DAQ transitions, running %.0fx real time'
+          % (event_rate, transition_time, time_scale))
+
+    for pipelined in [False, True]:
+        mode = 'pipelined' if pipelined else 'sequential'
+        measure('scan_times (%s)' % mode, tt, sim, tt.scan_times, times_in_ns,
+                nevents_per_timestep=120, repeats=2, pipelined=pipelined)
+        measure('scan_times random (%s)' % mode, tt, sim, tt.scan_times, times_in_ns,
+                nevents_per_timestep=120, repeats=2, randomize=True,
+                pipelined=pipelined)
+        measure('scan_range (%s)' % mode, tt, sim, tt.scan_range, -0.001, 0.001,
+                0.0002, nevents_per_timestep=120, pipelined=pipelined)
+        measure('calibrate (%s)' % mode, tt, sim, tt.calibrate, pipelined=pipelined)
+
+    return
+
+
+if __name__ == '__main__':
+    main(*[float(a) for a in sys.argv[1:]])
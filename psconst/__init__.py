@@ -1,3 +1,2 @@
 # init
 from constants import *
-from paths     import *
@@ -1,46 +1,180 @@
 
 import os
+import re
+import errno
+import stat
+import binascii
+import tempfile
+import time
+import bisect
+import heapq
+import numbers
 import h5py
 import numpy
 
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+
+def calib_dir(env):
+    """ `env` can be a psana env or the calib dir itself (e.g. off psana) """
+    if isinstance(env, str):
+        return env
+    return env.calibDir()
+
 
 # new functions from TJ for happier, simplier times
 def calib_path(env, detector_type, detector_src, start, end='end', create_dir=True):
     fn = "%s-%s.h5" % (start, end)
-    base = os.path.join(env.calibDir(), detector_type, detector_src)
+    base = os.path.join(calib_dir(env), detector_type, detector_src)
     if create_dir and not os.path.exists(base):
         os.system('mkdir -p %s' % base)
     return os.path.join(base, fn)
 
 
-def find_calib_file(env, detector_type, detector_src, run):
+class CalibIndex(object):
+    """
+    Interval index over the <start>-<end><ext> calib files of one directory.
+
+    The run ranges are resolved once into disjoint segments, each mapped to
+    the file that wins there: among the files whose range includes a run,
+    the one with the latest start (ties go to the narrower range). A lookup
+    is then a bisection, O(log n).
+    """
+
+    _fn_re = re.compile(r'^(\d+)-(\d+|end)$')
+
+    def __init__(self, basepath, ext='.h5'):
+
+        ranges = []
+        for fn in os.listdir(basepath):
+            name, fn_ext = os.path.splitext(fn)
+            match = self._fn_re.match(name)
+            if (fn_ext != ext) or (match is None):
+                continue
+            start = int(match.group(1))
+            end = float('inf') if (match.group(2) == 'end') else int(match.group(2))
+            if end >= start:
+                ranges.append((start, end, fn))
+
+        # sweep over the range boundaries, keeping the files that cover the
+        # current segment in a heap ordered by preference
+        bounds = sorted(set([ r[0] for r in ranges ] +
+                            [ r[1] + 1 for r in ranges if r[1] != float('inf') ]))
+        ranges.sort()
+        covering = []
+        i = 0
+
+        self._seg_starts = []
+        self._seg_files  = []
+        for b in bounds:
+            while (i < len(ranges)) and (ranges[i][0] <= b):
+                start, end, fn = ranges[i]
+                heapq.heappush(covering, (-start, end, fn))
+                i += 1
+            while covering and (covering[0][1] < b):
+                heapq.heappop(covering)
+            winner = covering[0][2] if covering else None
+            if self._seg_files and (self._seg_files[-1] == winner):
+                continue
+            self._seg_starts.append(b)
+            self._seg_files.append(winner)
+
+        self.basepath = basepath
+        self.n_files = len(ranges)
+
+        return
+
+
+    def find(self, run):
+        """
+        The file (name) that covers `run`, `None` if there is none.
+        """
+        i = bisect.bisect_right(self._seg_starts, run) - 1
+        if i < 0:
+            return None
+        return self._seg_files[i]
+
+
+# basepath, ext --> (directory signature, time indexed, CalibIndex)
+_CALIB_INDEX_CACHE = {}
+
+# directory mtimes can have a 1 s resolution: an index built within this
+# long of the last change may have missed a file added in the same tick
+_MTIME_RESOLUTION = 1.0
+
+
+def _calib_index(basepath, ext='.h5'):
+    """ the CalibIndex for `basepath`, rebuilt if the directory changed """
+
+    st = os.stat(basepath)
+    sig = (getattr(st, 'st_mtime_ns', st.st_mtime), st.st_size, st.st_ino)
+    key = (basepath, ext)
+    cached = _CALIB_INDEX_CACHE.get(key)
+    if (cached is None) or (cached[0] != sig) or \
+       (cached[1] - st.st_mtime <= _MTIME_RESOLUTION):
+        cached = (sig, time.time(), CalibIndex(basepath, ext=ext))
+        _CALIB_INDEX_CACHE[key] = cached
+
+    return cached[2]
+
+
+def _drop_calib_index(basepath):
+    """ forget the cached CalibIndex of `basepath` (after writing to it) """
+    basepath = os.path.abspath(basepath)
+    for key in list(_CALIB_INDEX_CACHE.keys()):
+        if os.path.abspath(key[0]) == basepath:
+            del _CALIB_INDEX_CACHE[key]
+    return
+
+
+def find_calib_file(env, detector_type, detector_src, run, ext='.h5'):
     """
     logic: choose calib with starting range closest to desired run, being
            sure the range for that calib includes this run
+
+    Files are named <start>-<end><ext>, `end` can be 'end' (open ended).
+    The directory is indexed once and re-indexed when it changes (or was
+    changed too recently to tell, or a file was saved there with `save`),
+    see CalibIndex.
     """
 
-    basepath = os.path.join(env.calibDir(), detector_type, detector_src)
+    basepath = os.path.join(calib_dir(env), detector_type, detector_src)
 
-    nearest = '0-end.data'
-    s_and_e = lambda s : s.split('.')[0].split('-')
+    if not os.path.isdir(basepath):
+        raise IOError('No calib directory: %s' % basepath)
 
-    for fn in os.listdir(basepath):
-        start, end = s_and_e(fn)
-        start = int(start)
-        end = 999999 if (end == 'end') else int(end)
-        if (start <= run) and (run <= end):
-            if start > int(s_and_e(nearest)[0]):
-                nearest = fn
-        else:
-            raise IOError('No valid calib file found for run: %d' % run)
+    fn = _calib_index(basepath, ext=ext).find(run)
+    if fn is None:
+        raise IOError('No valid calib file found for run: %d' % run)
 
-    return os.path.join(basepath, nearest)
+    return os.path.join(basepath, fn)
 
 
+CHUNK_BYTES = 1 << 20     # target chunk size for compressed arrays
+MIN_COMPRESS_BYTES = 1 << 16 # smaller arrays are never chunked
+
+def _chunk_shape(shape,itemsize,target=CHUNK_BYTES):
+    '''chunks of ~target bytes: full trailing dimensions, as many rows of
+    the leading ones as fit'''
+    chunks = list(shape)
+    nbytes = itemsize * int(numpy.prod(shape))
+    for i in range(len(chunks)):
+        if nbytes <= target:
+            break
+        row_bytes = nbytes // chunks[i]
+        chunks[i] = max(1, min(chunks[i], target // max(row_bytes,1)))
+        nbytes = row_bytes * chunks[i]
+    return tuple(chunks)
+
 class ConstantsStore(object):
-    def __init__(self,obj,file):
+    def __init__(self,obj,file,compression=None,compression_opts=None):
         self.f = h5py.File(file,'w')
         self.cwd = ''
+        self.compression = compression
+        self.compression_opts = compression_opts
         for k in obj.keys():
             subobj = obj[k]
             self.dispatch(subobj,str(k))
@@ -55,17 +189,39 @@ class ConstantsStore(object):
         self.cwd = self.cwd[:self.cwd.rfind('/')]
     def typeok(self,obj,name):
         '''check if we support serializing this type to hdf'''
-        allowed = [dict,int,float,str,numpy.ndarray]
-        return type(obj) in allowed
+        allowed = (numbers.Number,str,bytes,type(u''),numpy.generic,numpy.ndarray,list,tuple)
+        return (obj is None) or isinstance(obj,allowed)
+    def toarray(self,v):
+        '''lists/tuples to arrays, unicode arrays to utf-8. unicode strings
+        are stored as utf-8 strings, str/bytes as ascii ones, so each comes
+        back as its own type. None is stored as an empty dataset'''
+        if v is None:
+            return h5py.Empty('f8')
+        if isinstance(v,type(u'')):
+            return numpy.array(v,dtype=h5py.special_dtype(vlen=type(u'')))
+        if isinstance(v,(list,tuple)):
+            v = numpy.asarray(v)
+        if isinstance(v,numpy.ndarray) and v.dtype.kind == 'U':
+            v = numpy.char.encode(v,'utf-8')
+        return v
     def storevalue(self,v,name):
-        '''persist one of the supported types to the hdf file'''
-        self.f[self.cwd+'/'+name] = v
+        '''persist one of the supported types to the hdf file. large arrays
+        are chunked and compressed if a compression filter was given,
+        otherwise they stay contiguous (so they can be memory-mapped)'''
+        v = self.toarray(v)
+        kwargs = {}
+        if (self.compression is not None) and isinstance(v,numpy.ndarray) \
+                and v.nbytes >= MIN_COMPRESS_BYTES and v.dtype.kind != 'O':
+            kwargs = { 'chunks'           : _chunk_shape(v.shape,v.dtype.itemsize),
+                       'compression'      : self.compression,
+                       'compression_opts' : self.compression_opts,
+                       'shuffle'          : True }
+        self.f.create_dataset(self.cwd+'/'+name,data=v,**kwargs)
     def dict(self,d,name):
         '''called for every dictionary level to create a new hdf group name.
         it then looks into the dictionary to see if other groups need to
         be created'''
-        if self.cwd is '':
-            self.f.create_group(name)
+        self.f.require_group(self.cwd+'/'+name)
         self.pushdir(name)
         for k in d.keys():
             self.dispatch(d[k],str(k))
@@ -73,11 +229,14 @@ class ConstantsStore(object):
     def dispatch(self,obj,name):
         '''either persist a supported object, or look into a dictionary
         to see what objects need to be persisted'''
-        if type(obj) is dict:
+        if isinstance(obj,dict):
             self.dict(obj,name)
         else:
             if self.typeok(obj,name):
-                self.storevalue(obj,name)
+                try:
+                    self.storevalue(obj,name)
+                except TypeError:
+                    print('Constants.py: variable "'+name+'" of type "'+type(obj).__name__+'" could not be stored')
             else:
                 print('Constants.py: variable "'+name+'" of type "'+type(obj).__name__+'" not supported')
 
@@ -100,7 +259,7 @@ class ConstantsLoad(object):
                
             self.setval(remainder,obj[dictname])
         else:
-            obj[name]=self.f[self.fullname].value
+            obj[name]=_read_dataset(self.f[self.fullname],mmap=False)
 
     def loadCallBack(self,name,obj):
         '''called back by h5py routine visititems for each
@@ -110,19 +269,136 @@ class ConstantsLoad(object):
         self.fullname = name
         self.setval(name,self.obj)
 
-def load(file):
-    '''takes a string filename, and returns a constants object.'''
+def _is_utf8(ds):
+    '''is ds a string dataset stored as utf-8 (i.e. was it unicode)'''
+    tid = ds.id.get_type()
+    return tid.get_class() == h5py.h5t.STRING and tid.get_cset() == h5py.h5t.CSET_UTF8
+
+def _read_dataset(ds,mmap=True):
+    '''read a dataset. contiguous, uncompressed arrays are memory-mapped
+    (read-only) instead if mmap is True. arrays holding objects (strings,
+    vlen fields of structured arrays) or whose file layout differs from
+    their numpy dtype are always read.'''
+    if ds.shape is None:
+        return None # stored None
+    if ds.shape == ():
+        v = ds[()]
+        if isinstance(v,bytes) and _is_utf8(ds):
+            v = v.decode('utf-8')
+        return v
+    if mmap and ds.chunks is None and ds.size > 0 and \
+       ds.dtype.kind not in 'OSU' and not ds.dtype.hasobject and \
+       ds.id.get_type().get_size() == ds.dtype.itemsize:
+        offset = ds.id.get_offset()
+        if offset is not None:
+            return numpy.memmap(ds.file.filename,mode='r',dtype=ds.dtype,
+                                offset=offset,shape=ds.shape)
+    return ds[...]
+
+class ConstantsView(Mapping):
+    '''lazy, read-only dict-like view of a constants file. groups are
+    returned as views, datasets are read (or memory-mapped) on first
+    access and cached. keys can be paths, view['a/b'] == view['a']['b'].
+    use as a context manager, or call close(), to release the file.'''
+    def __init__(self,file,mmap=True,_group=None):
+        if _group is None:
+            _group = h5py.File(file,'r')
+        self.group = _group
+        self.mmap = mmap
+        self.cache = {}
+    def __getitem__(self,key):
+        if key not in self.cache:
+            obj = self.group[key]
+            if isinstance(obj,h5py.Group):
+                self.cache[key] = ConstantsView(None,mmap=self.mmap,_group=obj)
+            else:
+                self.cache[key] = _read_dataset(obj,mmap=self.mmap)
+        return self.cache[key]
+    def __contains__(self,key):
+        return key in self.group
+    def __iter__(self):
+        return iter(self.group.keys())
+    def __len__(self):
+        return len(self.group)
+    def __enter__(self):
+        return self
+    def __exit__(self,*args):
+        self.close()
+    def __repr__(self):
+        return '<ConstantsView %s:%s (%d keys)>' % (self.group.file.filename,
+                                                    self.group.name,len(self))
+    def to_dict(self,mmap=True):
+        '''read everything into a (nested) dict. memory-mapped arrays stay
+        memory-mapped unless mmap is False, then they are copied into memory
+        and the dict does not depend on the file.'''
+        d = {}
+        for k in self:
+            v = self[k]
+            if isinstance(v,ConstantsView):
+                v = v.to_dict(mmap=mmap)
+            elif not mmap and isinstance(v,numpy.memmap):
+                v = numpy.array(v)
+            d[k] = v
+        return d
+    def close(self):
+        '''close the file. memory-mapped arrays stay valid.'''
+        if self.group.file:
+            self.group.file.close()
+
+def load(file,lazy=True,mmap=True):
+    '''takes a string filename, and returns a constants object.
+    by default a lazy ConstantsView, with lazy=False a nested dict with
+    everything read.'''
+    if lazy:
+        return ConstantsView(file,mmap=mmap)
     c = ConstantsLoad(file)
     return c.obj
 
-def save(file,obj):
+def _temp_file(file):
+    '''create an empty, uniquely named temporary file next to file. unlike
+    mkstemp (0600), it gets the mode a plain open() would: 0666 less the
+    umask, applied by the kernel (reading the umask would mean changing
+    it, for all threads).'''
+    dirname,basename = os.path.split(file)
+    for i in range(tempfile.TMP_MAX):
+        tmp = os.path.join(dirname,'.%s.%s.tmp' % (basename,
+                           binascii.hexlify(os.urandom(6)).decode('ascii')))
+        try:
+            fd = os.open(tmp,os.O_WRONLY|os.O_CREAT|os.O_EXCL,0o666)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                continue
+            raise
+        os.close(fd)
+        return tmp
+    raise IOError(errno.EEXIST,'no free temporary file name for %s' % file)
+
+def save(file,obj,compression=None,compression_opts=None):
     '''store a constants object in an hdf5 file.  the object
     can be a hierarchy (defined by python dictionaries) and
-    hdf5 supported types (int, float, numpy.ndarray, string).
+    hdf5 supported types (int, long, float, complex, bool, str, unicode,
+    None, numpy scalars, numpy.ndarray incl. structured arrays, lists/tuples
+    of numbers).  str and unicode load back as str and unicode.
     the hierarchy can be created by having one value of
-    a dictionary itself be a dictionary.'''
-    
-    c = ConstantsStore(obj,file)
+    a dictionary itself be a dictionary.
+
+    compression ('gzip', 'lzf', ...) applies to large arrays only, which
+    are then chunked. the file is written to a temporary file next to it
+    and renamed, so readers never see a partial file.'''
+
+    file = os.path.abspath(file)
+    tmp = _temp_file(file)
+    try:
+        c = ConstantsStore(obj,tmp,compression=compression,
+                           compression_opts=compression_opts)
+        # a file that is replaced keeps its mode
+        if os.path.exists(file):
+            os.chmod(tmp,stat.S_IMODE(os.stat(file).st_mode))
+        os.rename(tmp,file)
+    except:
+        os.remove(tmp)
+        raise
+    _drop_calib_index(os.path.dirname(file))
 
 
 if __name__ == '__main__': 
@@ -140,6 +416,7 @@ if __name__ == '__main__':
     psconst.save(fout, writedict)
 
     fin = psconst.find_calib_file(ds.env(), detector_type, detector_src, 30)
-    readdict = psconst.load(fin)
+    with psconst.load(fin) as c:
+        readdict = c.to_dict()
     print 'write:', writedict, '-->', fout
     print 'read:', fin, '-->', readdict
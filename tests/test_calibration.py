@@ -0,0 +1,41 @@
+import numpy as np
+
+from timescans.calibration import PolyfitMoments
+
+
+def _edges_and_delays(order, n=100000, seed=0):
+    # timetool edge positions (pixels) and laser delays (ns)
+    rs = np.random.RandomState(seed)
+    x = rs.uniform(200.0, 800.0, n)
+    coeffs = [3.0e-9, -2.0e-6, 1.5e-3, -0.4][-(order + 1):]
+    y = np.polyval(coeffs, x) + rs.normal(0.0, 1.0e-5, n)
+    return x, y
+
+
+def test_polyfit_moments_matches_polyfit():
+    for order in [1, 2, 3]:
+        x, y = _edges_and_delays(order)
+        m = PolyfitMoments(order=order, x_range=(200, 800), bin_size=50)
+        for i in range(0, x.shape[0], 4096):
+            m.update(x[i:i+4096], y[i:i+4096])
+        fit = m.solve()
+        ref = np.polyfit(x, y, order)
+        assert np.allclose(fit, ref, rtol=1.0e-9, atol=0.0)
+        assert np.allclose(np.polyval(fit, x), np.polyval(ref, x), rtol=0.0, atol=1.0e-12)
+
+
+def test_polyfit_moments_merge():
+    x, y = _edges_and_delays(2)
+    a = PolyfitMoments(order=2, x_range=(200, 800))
+    b = PolyfitMoments(order=2, x_range=(200, 800))
+    a.update(x[::2], y[::2])
+    b.update(x[1::2], y[1::2])
+    assert np.allclose(a.merge(b).solve(), np.polyfit(x, y, 2), rtol=1.0e-9, atol=0.0)
+
+    c = PolyfitMoments(order=2, x_range=(100, 700))
+    try:
+        a.merge(c)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('merged moments over different x ranges')
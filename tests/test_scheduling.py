@@ -0,0 +1,35 @@
+import numpy as np
+
+from timescans import scheduling
+
+
+TIMES = np.linspace(-0.002, 0.002, 21)
+
+
+def test_orderings_visit_each_timepoint():
+    for method in scheduling.ORDERINGS:
+        for repeats in [1, 3]:
+            order = scheduling.order_timepoints(TIMES, repeats=repeats, method=method,
+                                                random_state=0)
+            assert np.array_equal(np.sort(order), np.sort(np.tile(TIMES, repeats)))
+
+
+def test_orderings_are_randomized():
+    # a single repeat (the scan_times default) must not be one of a handful
+    # of fixed (monotone) orders
+    for method in scheduling.ORDERINGS:
+        orders = set()
+        for seed in range(20):
+            order = scheduling.order_timepoints(TIMES, repeats=1, method=method,
+                                                random_state=seed)
+            orders.add(tuple(order))
+        assert len(orders) > 2, method
+
+
+def test_sweep_travel_is_bounded():
+    full_range = TIMES.max() - TIMES.min()
+    for seed in range(20):
+        order = scheduling.order_timepoints(TIMES, repeats=1, method='sweep',
+                                            random_state=seed)
+        travel = np.abs(np.diff(order)).sum()
+        assert travel <= 2 * (1 + scheduling.SWEEP_JITTER) * full_range
@@ -0,0 +1,37 @@
+import os
+
+import h5py
+import numpy as np
+
+from timescans import smalldata
+
+
+def test_write_array_overwrites_in_place(tmpdir):
+
+    path = str(tmpdir.join('run0001.h5'))
+    data = np.random.RandomState(0).rand(2, 201)
+
+    with smalldata.SmallDataWriter(path) as smd:
+        smd.write_array('laser_on_off/mean', data)
+        smd.flush()
+        size = os.path.getsize(path)
+        for i in range(200):
+            smd.write_array('laser_on_off/mean', data + i)
+        smd.flush()
+        assert os.path.getsize(path) <= size + data.nbytes
+
+    records = smalldata.load(path)
+    assert records.shape == (0,)
+    with h5py.File(path, 'r') as f:
+        assert np.array_equal(f['laser_on_off/mean'][:], data + 199)
+
+
+def test_write_array_new_shape(tmpdir):
+
+    path = str(tmpdir.join('run0001.h5'))
+    with smalldata.SmallDataWriter(path) as smd:
+        smd.write_array('counts', np.zeros(2, dtype=np.int64))
+        smd.write_array('counts', np.arange(3.0))
+
+    with h5py.File(path, 'r') as f:
+        assert np.array_equal(f['counts'][:], np.arange(3.0))
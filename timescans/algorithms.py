@@ -6,13 +6,15 @@ A grab-bag of algorithms we'll need...
 
 import os
 import h5py
+import hashlib
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 
-
 class RadialAverager(object):
 
-    def __init__(self, q_values, mask, n_bins=101):
+    def __init__(self, q_values, mask, n_bins=101, n_threads=1,
+                 threshold=None, gain=None, pedestal=None):
         """
         Parameters
         ----------
@@ -22,26 +24,273 @@ class RadialAverager(object):
             A boolean (int) saying if each pixel is masked or not
         n_bins : int
             The number of bins to employ. If `None` guesses a good value.
+        n_threads : int
+            The number of worker threads to bin each image with. The bins
+            are split into `n_threads` contiguous ranges of roughly equal
+            pixel count, each range is handled by one thread.
+        threshold : float
+            Default ADU threshold: pixels with (corrected) intensity below
+            this value are counted as zero. Can be overridden per call.
+        gain, pedestal : np.ndarray (float)
+            Optional per-pixel gain and pedestal, same shape as `q_values`.
+            If given, each pixel is corrected as (image - pedestal) * gain
+            before thresholding and binning, in the same pass.
+
+        Notes
+        -----
+        Only the unmasked pixels are kept: their flat indices (int32) and
+        their bin assignments. The full-detector `q_values` and `mask`
+        are not referenced after construction.
         """
 
-        self.q_values = q_values
-        self.mask = mask
+        if not (q_values.shape == mask.shape):
+            raise ValueError('`q_values` and `mask` must have the same shape')
+
+        self.shape = q_values.shape
         self.n_bins = n_bins
 
-        self.q_range = self.q_values.max() - self.q_values.min()
+        self.q_min = q_values.min()
+        self.q_range = q_values.max() - self.q_min
         self.bin_width = self.q_range / (float(n_bins) - 1)
 
-        self._bin_assignments = np.floor( (self.q_values - self.q_values.min()) / self.bin_width ).astype(np.int32)
-        self._normalization_array = (np.bincount( self._bin_assignments.flatten(), weights=self.mask.flatten() ) \
-                                    + 1e-100).astype(np.float)
+        bin_assignments = np.floor( (q_values - self.q_min) / self.bin_width ).astype(np.int32)
+        assert self.n_bins >= bin_assignments.max() + 1, 'incorrect bin assignments'
+
+        # compact pixel index: unmasked pixels only, kept in (ascending) pixel
+        # order so that each bin is summed in the same order as before and
+        # the gather streams through the image
+        self._pixel_index = np.flatnonzero(mask).astype(np.int32)
+        self._pixel_bins  = bin_assignments.ravel()[self._pixel_index].astype(np.intp)
+
+        # only keep per-pixel weights if the mask is not just 0/1
+        weights = mask.ravel()[self._pixel_index].astype(np.float64)
+        if np.all(weights == 1.0):
+            self._pixel_weights = None
+        else:
+            self._pixel_weights = weights
+
+        self._normalization_array = (np.bincount( self._pixel_bins, weights=weights,
+                                                 minlength=self.n_bins ) \
+                                    + 1e-100).astype(np.float64)
+
+        self._setup(n_threads, threshold, gain, pedestal)
+
+        return
+
+
+    def _setup(self, n_threads, threshold, gain, pedestal, chunked=False):
+        """
+        Split the work between threads, allocate the buffers and compact the
+        per-pixel corrections. Needs the compact pixel index, bins, weights
+        and normalization, in pixel order or, if `chunked`, already grouped
+        for `n_threads` (see `to_arrays`).
+        """
+
+        # split the bins into contiguous ranges, one per thread, and group
+        # the compact index by range (stable, so the order of the pixels in
+        # each bin -- and hence the sums -- are unchanged)
+        self.n_threads = max(int(n_threads), 1)
+        bin_counts = np.bincount(self._pixel_bins, minlength=self.n_bins)
+        cum_counts = np.cumsum(bin_counts)
+        bin_edges = np.searchsorted(cum_counts, np.arange(1, self.n_threads) *
+                                    (self.n_pixels / float(self.n_threads)))
+        self._chunk_bins = np.concatenate([[0], bin_edges, [self.n_bins]])
+
+        if (self.n_threads > 1) and not chunked:
+            order = np.argsort(np.searchsorted(self._chunk_bins, self._pixel_bins, side='right'),
+                               kind='mergesort')
+            self._pixel_index = self._pixel_index[order]
+            self._pixel_bins  = self._pixel_bins[order]
+            if self._pixel_weights is not None:
+                self._pixel_weights = self._pixel_weights[order]
+
+        self._chunk_pixels = np.concatenate([[0], cum_counts])[self._chunk_bins]
+        self._pool = None
+
+        # gather buffers, one per input dtype, reused between calls
+        self._buffers = {}
+        self._keep = np.empty(self.n_pixels, dtype=np.bool_)
+
+        # per-pixel corrections, compacted like the pixel index
+        self.threshold = threshold
+        self._pixel_gain = None
+        self._pixel_pedestal = None
+        for name, value in [('gain', gain), ('pedestal', pedestal)]:
+            if value is None:
+                continue
+            if not (value.shape == self.shape):
+                raise ValueError('`%s` and `q_values` must have the same shape' % name)
+            setattr(self, '_pixel_' + name, value.ravel()[self._pixel_index].astype(np.float64))
+
+        if self._corrected:
+            self._corrected_values = np.empty(self.n_pixels)
+
+        return
+
+
+    @classmethod
+    def from_arrays(cls, arrays, n_threads=1, threshold=None, gain=None,
+                    pedestal=None):
+        """
+        Create a RadialAverager from the precomputed arrays returned by
+        `to_arrays` (e.g. read from a cache file, or broadcast from another
+        rank), without the full-detector `q_values` and `mask`.
+
+        Parameters
+        ----------
+        arrays : dict
+            See `to_arrays`. The arrays are used as they are (not copied)
+            when their dtypes already match and they are in pixel order
+            with `n_threads` = 1, or grouped for `n_threads` already.
+        n_threads, threshold, gain, pedestal
+            See `__init__`.
+        """
+
+        ra = cls.__new__(cls)
+
+        ra.shape     = tuple(int(x) for x in arrays['shape'])
+        ra.n_bins    = int(arrays['n_bins'])
+        ra.q_min     = float(arrays['q_min'])
+        ra.q_range   = float(arrays['q_range'])
+        ra.bin_width = ra.q_range / (float(ra.n_bins) - 1)
+
+        ra._pixel_index         = np.asarray(arrays['pixel_index'], dtype=np.int32)
+        ra._pixel_bins          = np.asarray(arrays['pixel_bins'], dtype=np.intp)
+        ra._normalization_array = np.asarray(arrays['normalization'], dtype=np.float64)
+        if arrays.get('pixel_weights') is None:
+            ra._pixel_weights = None
+        else:
+            ra._pixel_weights = np.asarray(arrays['pixel_weights'], dtype=np.float64)
+
+        # grouped for another number of threads: back to pixel order first
+        n_threads = max(int(n_threads), 1)
+        chunked_for = int(arrays.get('n_threads', 1))
+        if (chunked_for > 1) and (chunked_for != n_threads):
+            order = np.argsort(ra._pixel_index, kind='mergesort')
+            ra._pixel_index = ra._pixel_index[order]
+            ra._pixel_bins  = ra._pixel_bins[order]
+            if ra._pixel_weights is not None:
+                ra._pixel_weights = ra._pixel_weights[order]
+
+        ra._setup(n_threads, threshold, gain, pedestal,
+                  chunked=(chunked_for == n_threads))
+
+        return ra
+
+
+    def to_arrays(self, chunked=False):
+        """
+        The precomputed state of the averager, see `from_arrays`.
+
+        Parameters
+        ----------
+        chunked : bool
+            If true, the pixel arrays are left grouped for this averager's
+            `n_threads`, so averagers with as many threads can use them in
+            place (e.g. from shared memory). Otherwise they are in pixel
+            order, as saved in cache files.
+
+        Returns
+        -------
+        arrays : dict
+            'shape', 'n_bins', 'q_min', 'q_range', 'n_threads' (the number
+            of threads the pixel arrays are grouped for, 1 for pixel order)
+            and the compact 'pixel_index' (int32), 'pixel_bins' (int32),
+            'pixel_weights' (`None` for a 0/1 mask) and 'normalization'
+            arrays.
+        """
+
+        if chunked or (self.n_threads == 1):
+            order = slice(None)
+            n_threads = self.n_threads
+        else:
+            order = np.argsort(self._pixel_index, kind='mergesort')
+            n_threads = 1
+
+        arrays = { 'shape'         : self.shape,
+                   'n_bins'        : self.n_bins,
+                   'q_min'         : self.q_min,
+                   'q_range'       : self.q_range,
+                   'n_threads'     : n_threads,
+                   'pixel_index'   : self._pixel_index[order],
+                   'pixel_bins'    : self._pixel_bins[order].astype(np.int32),
+                   'pixel_weights' : None,
+                   'normalization' : self._normalization_array }
+        if self._pixel_weights is not None:
+            arrays['pixel_weights'] = self._pixel_weights[order]
+
+        return arrays
+
+
+    @property
+    def n_pixels(self):
+        """
+        The number of unmasked pixels that contribute to the average.
+        """
+        return self._pixel_index.shape[0]
+
+
+    def close(self):
+        """
+        Stop the worker threads (n_threads > 1). The averager can still be
+        used, a new pool is started when needed.
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        return
+
+
+    @property
+    def _corrected(self):
+        return (self._pixel_gain is not None) or (self._pixel_pedestal is not None)
+
+
+    def _buffer(self, dtype):
+        if dtype not in self._buffers:
+            self._buffers[dtype] = np.empty(self.n_pixels, dtype=dtype)
+        return self._buffers[dtype]
+    
+
+    def _bin_chunk(self, flat_image, values, threshold, chunk, bin_values):
+        """
+        Gather, correct, threshold and bin the pixels of one chunk (bin
+        range), writing the sums for those bins into `bin_values`.
+        """
+
+        p0, p1 = self._chunk_pixels[chunk], self._chunk_pixels[chunk+1]
+        b0, b1 = self._chunk_bins[chunk],   self._chunk_bins[chunk+1]
+
+        chunk_values = values[p0:p1]
+        np.take(flat_image, self._pixel_index[p0:p1], out=chunk_values, mode='clip')
 
-        assert self.n_bins >= self._bin_assignments.max() + 1, 'incorrect bin assignments'
-        self._normalization_array = self._normalization_array[:self.n_bins]
+        if self._corrected:
+            raw_values, chunk_values = chunk_values, self._corrected_values[p0:p1]
+            if self._pixel_pedestal is not None:
+                np.subtract(raw_values, self._pixel_pedestal[p0:p1], out=chunk_values)
+            else:
+                chunk_values[:] = raw_values
+            if self._pixel_gain is not None:
+                np.multiply(chunk_values, self._pixel_gain[p0:p1], out=chunk_values)
+
+        # zeroing by multiplying with the (reused) boolean buffer is several
+        # times faster than np.putmask or boolean-index assignment
+        if threshold is not None:
+            keep = self._keep[p0:p1]
+            np.greater_equal(chunk_values, threshold, out=keep)
+            np.multiply(chunk_values, keep, out=chunk_values)
+
+        if self._pixel_weights is not None:
+            chunk_values = chunk_values * self._pixel_weights[p0:p1]
+
+        bin_values[b0:b1] = np.bincount(self._pixel_bins[p0:p1], weights=chunk_values,
+                                        minlength=b1)[b0:b1]
 
         return
     
 
-    def __call__(self, image):
+    def __call__(self, image, threshold=None):
         """
         Bin pixel intensities by their momentum transfer.
         
@@ -50,6 +299,11 @@ class RadialAverager(object):
         image : np.ndarray
             The intensity at each pixel, same shape as pixel_pos
 
+        threshold : float
+            If not `None`, pixels with (corrected) intensity below this value
+            are counted as zero (`image` itself is not modified). Defaults to
+            the threshold passed at construction.
+
 
         Returns
         -------
@@ -60,25 +314,163 @@ class RadialAverager(object):
             The average intensity in the bin.
         """
 
-        if not (image.shape == self.q_values.shape):
+        if not (image.shape == self.shape):
             raise ValueError('`image` and `q_values` must have the same shape')
-        if not (image.shape == self.mask.shape):
-            raise ValueError('`image` and `mask` must have the same shape')
 
-        weights = image.flatten() * self.mask.flatten()
-        bin_values = np.bincount(self._bin_assignments.flatten(), weights=weights)
-        bin_values /= self._normalization_array
+        if threshold is None:
+            threshold = self.threshold
 
-        assert bin_values.shape[0] == self.n_bins
+        bin_values = np.empty(self.n_bins)
+        self._average(image, threshold, bin_values)
 
         return bin_values
-    
+
+
+    def _average(self, image, threshold, bin_values):
+        """
+        The work of `__call__`, writing the averages into `bin_values`.
+        """
+
+        # gather the unmasked pixels (no copy of `image` if contiguous)
+        flat_image = image.reshape(-1)
+        values = self._buffer(image.dtype)
+
+        if self.n_threads > 1:
+            if self._pool is None:
+                self._pool = ThreadPool(self.n_threads)
+            self._pool.map(lambda c : self._bin_chunk(flat_image, values, threshold, c, bin_values),
+                           range(self.n_threads))
+        else:
+            self._bin_chunk(flat_image, values, threshold, 0, bin_values)
+
+        bin_values /= self._normalization_array
+
+        return
+
+
+    def batch(self, images, out=None, threshold=None):
+        """
+        Bin pixel intensities by their momentum transfer for a stack of
+        images.
+
+        A convenience wrapper, not a faster path: each image goes through
+        the same compact per-frame code as `__call__`, only writing into
+        the rows of `out`. The per-frame gather + bincount is memory bound,
+        and every whole-stack kernel tried was slower on CSPAD frames: a
+        sparse pixel-to-bin matrix product, one bincount over
+        `frame * n_bins + bin` for the gathered stack, and np.add.reduceat
+        over bin-sorted pixels or same-bin pixel runs.
+
+        Parameters
+        ----------
+        images : np.ndarray
+            A stack of images, shape (N,) + q_values.shape, e.g. an
+            (N, 32, 185, 388) block of CSPAD frames.
+
+        out : np.ndarray
+            Optional (N, n_bins) float array to write the result into.
+
+        threshold : float
+            See `__call__`.
+
+        Returns
+        -------
+        bin_values : ndarray, float
+            An (N, n_bins) array, the average intensity in each bin for
+            each image.
+        """
+
+        if not (images.shape[1:] == self.shape):
+            raise ValueError('`images` must be a stack of arrays shaped like '
+                             '`q_values`')
+
+        n_images = images.shape[0]
+        if out is None:
+            out = np.empty((n_images, self.n_bins))
+        elif out.shape != (n_images, self.n_bins):
+            raise ValueError('`out` must have shape (%d, %d)' % (n_images, self.n_bins))
+
+        if threshold is None:
+            threshold = self.threshold
+
+        for i in range(n_images):
+            self._average(images[i], threshold, out[i])
+
+        return out
+
 
     @property
     def bin_centers(self):
-        return (np.arange(self.n_bins) + 0.5) * self.bin_width + self.q_values.min()
+        return (np.arange(self.n_bins) + 0.5) * self.bin_width + self.q_min
         
         
+def geometry_hash(q_values, mask, n_bins):
+    """
+    Content hash (sha1 hex digest) of the inputs of a RadialAverager, to
+    validate an averager cache file.
+    """
+    h = hashlib.sha1()
+    h.update(repr((q_values.shape, q_values.dtype.str, mask.dtype.str, int(n_bins))).encode('ascii'))
+    h.update(np.ascontiguousarray(q_values).view(np.uint8))
+    h.update(np.ascontiguousarray(mask).view(np.uint8))
+    return h.hexdigest()
+
+
+def save_averager_cache(path, arrays, content_hash):
+    """
+    Write the precomputed arrays of a RadialAverager (see `to_arrays`) to
+    an HDF5 cache file, tagged with `content_hash` (see
+    `geometry_hash`). The file is written under a temporary name and
+    renamed, so other jobs never read a partial cache.
+    """
+
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+
+    with h5py.File(tmp_path, 'w') as f:
+        f.attrs['content_hash'] = content_hash
+        for k in ['shape', 'n_bins', 'q_min', 'q_range']:
+            f.attrs[k] = arrays[k]
+        for k in ['pixel_index', 'pixel_bins', 'pixel_weights', 'normalization']:
+            if arrays[k] is not None:
+                f.create_dataset(k, data=arrays[k])
+
+    os.rename(tmp_path, path)
+
+    return
+
+
+def load_averager_cache(path, content_hash=None):
+    """
+    Read an averager cache file written by `save_averager_cache`.
+
+    Parameters
+    ----------
+    path : str
+        The cache file.
+    content_hash : str
+        If passed, the cache is only used if it was built from the same
+        inputs (see `geometry_hash`).
+
+    Returns
+    -------
+    arrays : dict
+        The arrays for `RadialAverager.from_arrays`, or `None` if there is
+        no (valid) cache.
+    """
+
+    if not os.path.exists(path):
+        return None
+
+    with h5py.File(path, 'r') as f:
+        if (content_hash is not None) and (f.attrs.get('content_hash') != content_hash):
+            return None
+        arrays = dict([ (k, f.attrs[k]) for k in ['shape', 'n_bins', 'q_min', 'q_range'] ])
+        for k in ['pixel_index', 'pixel_bins', 'pixel_weights', 'normalization']:
+            arrays[k] = f[k][:] if k in f else None
+
+    return arrays
+
+
 def update_average(n, A, B):
     """
     updates a numpy matrix A that represents an average over the previous n-1 shots
@@ -93,6 +485,306 @@ def update_average(n, A, B):
         return
         
         
+def merge_moments(a, b):
+    """
+    Merge two packed (count, mean, M2) arrays, as kept by
+    `ProfileAccumulator.state`, into `b` (in place).
+
+    Uses the pairwise update of Chan et al., which is exact (up to rounding)
+    and stable, so partial results can be combined in any order -- e.g. as
+    the operation of an MPI reduction.
+
+    Parameters
+    ----------
+    a, b : np.ndarray
+        Arrays of shape (n_classes, 1 + 2 * n_bins). Column 0 is the count,
+        the next n_bins columns the mean and the last n_bins columns the
+        sum of squared deviations from the mean (M2) for each class.
+
+    Returns
+    -------
+    b : np.ndarray
+        The merged state.
+    """
+
+    n_bins = (a.shape[1] - 1) // 2
+
+    n_a, mean_a, m2_a = a[:,:1], a[:,1:n_bins+1], a[:,n_bins+1:]
+    n_b, mean_b, m2_b = b[:,:1], b[:,1:n_bins+1], b[:,n_bins+1:]
+
+    n = n_a + n_b
+    frac_a = n_a / np.maximum(n, 1.0)
+    delta = mean_a - mean_b
+
+    m2_b += m2_a + np.square(delta) * (frac_a * n_b)
+    mean_b += delta * frac_a
+    n_b[:] = n
+
+    return b
+
+
+class ProfileAccumulator(object):
+    """
+    Streaming per-bin mean and variance (Welford) of radial profiles, kept
+    separately for a few classes of shots (e.g. laser on / laser off).
+
+    Memory use is O(n_classes * n_bins), independent of the number of shots.
+
+    Example
+    -------
+    >>> acc = ProfileAccumulator(n_bins, n_classes=2)
+    >>> acc.update(profiles, laser_on.astype(int)) # (N, n_bins), (N,)
+    >>> diff, diff_err = acc.difference(1, 0)
+    """
+
+    def __init__(self, n_bins, n_classes=2):
+        """
+        Parameters
+        ----------
+        n_bins : int
+            The length of each profile.
+        n_classes : int
+            The number of classes of shots to accumulate separately.
+        """
+
+        self.n_bins = n_bins
+        self.n_classes = n_classes
+
+        # counts, means and M2 live in one contiguous array, so the
+        # accumulator can be sent/reduced as a single buffer
+        self.state = np.zeros((n_classes, 1 + 2 * n_bins))
+
+        return
+
+
+    @property
+    def counts(self):
+        return self.state[:,0]
+
+
+    @property
+    def mean(self):
+        return self.state[:,1:self.n_bins+1]
+
+
+    @property
+    def m2(self):
+        return self.state[:,self.n_bins+1:]
+
+
+    @property
+    def variance(self):
+        """
+        The (sample) variance in each bin, shape (n_classes, n_bins).
+        """
+        return self.m2 / np.maximum(self.counts - 1.0, 1.0)[:,None]
+
+
+    @property
+    def sem(self):
+        """
+        The standard error of the mean in each bin, shape (n_classes, n_bins).
+        """
+        return np.sqrt(self.variance / np.maximum(self.counts, 1.0)[:,None])
+
+
+    def update(self, profiles, classes):
+        """
+        Add a block of profiles to the running statistics.
+
+        Parameters
+        ----------
+        profiles : np.ndarray
+            An (N, n_bins) array of profiles, or a single (n_bins,) profile.
+        classes : np.ndarray (int)
+            The class of each profile, length N (or an int for a single
+            profile). Profiles with a class outside [0, n_classes) are
+            ignored.
+        """
+
+        profiles = np.atleast_2d(profiles)
+        classes = np.atleast_1d(classes)
+
+        if profiles.shape != (classes.shape[0], self.n_bins):
+            raise ValueError('`profiles` must be (N, %d) and `classes` length N, got '
+                             '%s and %s' % (self.n_bins, profiles.shape, classes.shape))
+
+        ok = (classes >= 0) & (classes < self.n_classes)
+        profiles, classes = profiles[ok], classes[ok]
+
+        # statistics of the block per class, merged in one go
+        block = np.zeros_like(self.state)
+        for c in np.unique(classes):
+            p = profiles[classes == c]
+            block[c,0] = p.shape[0]
+            block[c,1:self.n_bins+1] = p.mean(axis=0)
+            block[c,self.n_bins+1:] = np.square(p - block[c,1:self.n_bins+1]).sum(axis=0)
+
+        merge_moments(block, self.state)
+
+        return
+
+
+    def merge(self, other):
+        """
+        Merge the statistics of another accumulator into this one.
+        """
+        if other.state.shape != self.state.shape:
+            raise ValueError('cannot merge accumulators of different shape')
+        merge_moments(other.state, self.state)
+        return self
+
+
+    def reset(self):
+        self.state[:] = 0.0
+        return
+
+
+    def difference(self, c1, c2):
+        """
+        The difference of the mean profiles of two classes, and its standard
+        error.
+
+        Parameters
+        ----------
+        c1, c2 : int
+            The classes to take the difference (c1 - c2) of.
+
+        Returns
+        -------
+        diff : np.ndarray
+            The difference, shape (n_bins,).
+        diff_err : np.ndarray
+            The standard error of `diff`.
+        """
+        diff = self.mean[c1] - self.mean[c2]
+        diff_err = np.sqrt(np.square(self.sem[c1]) + np.square(self.sem[c2]))
+        return diff, diff_err
+
+
+class DelayMap(object):
+    """
+    Online I(q, delay) map: sums and counts of profiles, binned by the
+    (timetool corrected) delay of each shot, per class of shots.
+
+    The state is a plain sum, so partial maps from different MPI ranks
+    can be combined with an ordinary (MPI.SUM) reduction of `state`.
+
+    Example
+    -------
+    >>> dmap = DelayMap(np.linspace(-1.0, 1.0, 41), n_bins, n_classes=2)
+    >>> dmap.update(profiles, laser_on.astype(int), delays_ps)
+    >>> diff = dmap.difference(1, 0) # (n_delays, n_bins)
+    """
+
+    def __init__(self, delay_edges, n_bins, n_classes=2):
+        """
+        Parameters
+        ----------
+        delay_edges : np.ndarray
+            The (monotonically increasing) edges of the delay bins.
+        n_bins : int
+            The length of each profile.
+        n_classes : int
+            The number of classes of shots to accumulate separately.
+        """
+
+        self.delay_edges = np.asarray(delay_edges, dtype=np.float64)
+        self.n_delays = self.delay_edges.shape[0] - 1
+        self.n_bins = n_bins
+        self.n_classes = n_classes
+
+        # column 0 holds the counts, the rest the summed profiles
+        self.state = np.zeros((n_classes, self.n_delays, 1 + n_bins))
+
+        return
+
+
+    @property
+    def delay_centers(self):
+        return 0.5 * (self.delay_edges[1:] + self.delay_edges[:-1])
+
+
+    @property
+    def counts(self):
+        return self.state[:,:,0]
+
+
+    @property
+    def sums(self):
+        return self.state[:,:,1:]
+
+
+    @property
+    def mean(self):
+        """
+        The mean profile in each (class, delay) cell, NaN where empty.
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sums / self.counts[:,:,None]
+
+
+    def update(self, profiles, classes, delays):
+        """
+        Add a block of profiles to the map.
+
+        Parameters
+        ----------
+        profiles : np.ndarray
+            An (N, n_bins) array of profiles.
+        classes : np.ndarray (int)
+            The class of each profile, length N. Profiles with a class outside
+            [0, n_classes) are ignored.
+        delays : np.ndarray (float)
+            The delay of each shot, length N. Shots outside the delay bins,
+            or with a NaN delay, are ignored.
+        """
+
+        profiles = np.atleast_2d(profiles)
+        classes = np.atleast_1d(classes)
+        delays = np.atleast_1d(delays)
+
+        if not (profiles.shape[0] == classes.shape[0] == delays.shape[0]):
+            raise ValueError('`profiles`, `classes` and `delays` must have the '
+                             'same length')
+
+        delay_bins = np.searchsorted(self.delay_edges, delays, side='right') - 1
+        ok = (delay_bins >= 0) & (delay_bins < self.n_delays) & \
+             (classes >= 0) & (classes < self.n_classes)
+
+        cells = classes[ok] * self.n_delays + delay_bins[ok]
+        flat_state = self.state.reshape(-1, 1 + self.n_bins)
+
+        flat_state[:,0] += np.bincount(cells, minlength=flat_state.shape[0])
+        np.add.at(flat_state[:,1:], cells, profiles[ok])
+
+        return
+
+
+    def merge(self, other):
+        """
+        Add the map of another DelayMap (with the same binning) to this one.
+        """
+        if other.state.shape != self.state.shape:
+            raise ValueError('cannot merge maps of different shape')
+        self.state += other.state
+        return self
+
+
+    def reset(self):
+        self.state[:] = 0.0
+        return
+
+
+    def difference(self, c1, c2):
+        """
+        The time-resolved difference map, mean(c1) - mean(c2), shape
+        (n_delays, n_bins). NaN for delays missing either class.
+        """
+        mean = self.mean
+        return mean[c1] - mean[c2]
+        
+        
 def normalize(q_values, intensities, q_min=2.5, q_max=6.5):
     """
     Crop and normalize an I(q) vector st. the area under the curve is one.
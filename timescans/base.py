@@ -47,6 +47,8 @@ except:
 
 import numpy as np
 
+from timescans import scheduling
+
 CURSOR_UP_ONE = '\x1b[1A'
 ERASE_LINE = '\x1b[2K'
 
@@ -71,6 +73,159 @@ def ns_to_mm(time):
     mm = meters * 1000.0
     return mm
 
+
+
+def tt_fit_coeffs(coeffs):
+    """
+    A timetool calibration in the `Timescaner.tt_fit_coeff` layout: the 3
+    coefficients of the quadratic delay (ns) vs. edge position (pixels),
+    highest power first (as np.polyfit). Lower order fits are padded with
+    zeros.
+
+    Raises
+    ------
+    ValueError
+        If `coeffs` is empty or of higher order than 2.
+    """
+
+    coeffs = np.atleast_1d(np.asarray(coeffs, dtype=np.float64)).ravel()
+    if (coeffs.shape[0] < 1) or (coeffs.shape[0] > 3):
+        raise ValueError('timetool calibrations are polynomials of order <= 2 '
+                         '(1 to 3 coefficients), got %d coefficients' % coeffs.shape[0])
+
+    return np.concatenate([ np.zeros(3 - coeffs.shape[0]), coeffs ])
+
+
+class PVSettleWaiter(object):
+    """
+    Track whether a PV has reached a target value, from its monitor
+    callbacks (no polling).
+
+    The PV is settled once its value has been within `tolerance` of
+    `target` for `dwell` seconds without leaving it. Create the waiter
+    before putting the new value, so no update is missed.
+    """
+
+    def __init__(self, pv, target, tolerance, dwell=0.0):
+        """
+        Parameters
+        ----------
+        pv : epics.PV
+            The PV to watch.
+        target : float
+            The value it should reach.
+        tolerance : float
+            How close (absolute) to `target` counts as reached.
+        dwell : float
+            How long (s) the value has to stay within tolerance.
+        """
+
+        self.pv = pv
+        self.target = target
+        self.tolerance = tolerance
+        self.dwell = dwell
+
+        self._cond = threading.Condition()
+        self._since = None # time the value entered the tolerance window
+        self._value = None
+
+        self._index = pv.add_callback(self._callback)
+        self._callback(value=pv.value)
+
+        return
+
+
+    def _callback(self, value=None, **kwargs):
+        with self._cond:
+            self._value = value
+            if (value is not None) and (abs(value - self.target) <= self.tolerance):
+                if self._since is None:
+                    self._since = time.time()
+            else:
+                self._since = None
+            self._cond.notify_all()
+        return
+
+
+    @property
+    def settled(self):
+        with self._cond:
+            return (self._since is not None) and (time.time() - self._since >= self.dwell)
+
+
+    def wait(self, timeout):
+        """
+        Block until the PV is settled, or `timeout` seconds have passed.
+
+        Returns
+        -------
+        settled : bool
+        """
+
+        deadline = time.time() + timeout
+        with self._cond:
+            while True:
+                now = time.time()
+                if (self._since is not None) and (now - self._since >= self.dwell):
+                    return True
+                if now >= deadline:
+                    return False
+                wake = deadline
+                if self._since is not None:
+                    wake = min(deadline, self._since + self.dwell)
+                self._cond.wait(wake - now)
+
+
+    def close(self):
+        """
+        Remove the monitor callback.
+        """
+        self.pv.remove_callback(self._index)
+        return
+
+
+def wait_for_settle(waiters, timeout):
+    """
+    Wait for several PVs (PVSettleWaiters) to be settled at the same time.
+    They move concurrently, so this takes as long as the slowest one.
+
+    Raises
+    ------
+    RuntimeError
+        If they are not all settled within `timeout` seconds, e.g. a motor
+        is stuck.
+    """
+
+    deadline = time.time() + timeout
+    while True:
+        for w in waiters:
+            w.wait(max(deadline - time.time(), 0.0))
+        if all([ w.settled for w in waiters ]):
+            return
+        if time.time() >= deadline:
+            stuck = [ w for w in waiters if not w.settled ]
+            raise RuntimeError('PV(s) did not settle within %.1f s: %s' % (timeout,
+                               ', '.join([ '%s at %s (target %f +/- %g)' % (w.pv.pvname,
+                                                                             w._value,
+                                                                             w.target,
+                                                                             w.tolerance)
+                                           for w in stuck ])))
+
+
+
+class EpicsBackend(object):
+    """
+    Hardware access for a Timescaner: EPICS PVs (pyepics) and the DAQ
+    (pydaq). See timescans.simulation.SimBackend for an in-process
+    stand-in with the same interface.
+    """
+
+    def PV(self, pvname):
+        return epics.PV(pvname)
+
+    def daq(self, daq_host, daq_platform):
+        return pydaq.Control(daq_host, daq_platform)
+
         
 class Timescaner(object):
     """
@@ -88,7 +243,10 @@ class Timescaner(object):
                  laser_delay_pv_name,
                  tt_stage_position_pv_name,
                  t0_pv_name,
-                 laser_lock_pv_name):
+                 laser_lock_pv_name,
+                 laser_delay_readback_pv_name=None,
+                 tt_stage_readback_pv_name=None,
+                 backend=None):
         """
         Create a Timescaner instance, providing control over the timetool
         and laser delay stages.
@@ -102,6 +260,21 @@ class Timescaner(object):
         t0_pv_name : str
         laser_lock_pv_name : str
 
+        Optional Parameters
+        -------------------
+        laser_delay_readback_pv_name : str
+            The PV to watch for the laser delay actually reached (rc file:
+            laser_delay_readback_pv_name). If `None`, laser delay moves are
+            not waited for at all (a warning is printed).
+        tt_stage_readback_pv_name : str
+            The PV to watch for the TT stage position actually reached. If
+            `None`, the .RBV field of the (motor record) TT stage PV. If
+            the TT stage is not a motor record, its moves are not waited
+            for (a warning is printed).
+        backend : object
+            Provides `PV(pvname)` and `daq(daq_host, daq_platform)`. If
+            `None`, the real hardware (EpicsBackend).
+
         See Also
         --------
         Timescaner.from_rc() : function
@@ -111,28 +284,120 @@ class Timescaner(object):
 
         self._daq_host = daq_host
         self._daq_platform = daq_platform
-        self.daq = pydaq.Control(daq_host, daq_platform)
+        if backend is None:
+            backend = EpicsBackend()
+        self.backend = backend
+        self.daq = backend.daq(daq_host, daq_platform)
                  
-        self._laser_delay        = epics.PV(laser_delay_pv_name)
-        self._tt_stage_position  = epics.PV(tt_stage_position_pv_name)
-        self._t0                 = epics.PV(t0_pv_name)
-        self._laser_lock         = epics.PV(laser_lock_pv_name)
+        self._laser_delay        = backend.PV(laser_delay_pv_name)
+        self._tt_stage_position  = backend.PV(tt_stage_position_pv_name)
+        self._t0                 = backend.PV(t0_pv_name)
+        self._laser_lock         = backend.PV(laser_lock_pv_name)
+
+        # moves are put to the PVs above, and are done when these read back
+        # the new value (a motor record's own value is its setpoint)
+        if laser_delay_readback_pv_name is None:
+            laser_delay_readback_pv_name = laser_delay_pv_name
+        if laser_delay_readback_pv_name == laser_delay_pv_name:
+            print "*** WARNING: no laser delay readback PV (set " \
+                  "laser_delay_readback_pv_name in the rc file), laser delay " \
+                  "moves are NOT waited for and a stuck delay goes unnoticed"
+        tt_stage_record          = tt_stage_position_pv_name.split('.')[0]
+        default_tt_stage_rbv     = (tt_stage_readback_pv_name is None)
+        if default_tt_stage_rbv:
+            tt_stage_readback_pv_name = tt_stage_record + '.RBV'
+        self._laser_delay_rbv    = backend.PV(laser_delay_readback_pv_name)
+        self._tt_stage_rbv       = backend.PV(tt_stage_readback_pv_name)
+
+        # the TT stage motor record's speed (mm/s), acceleration time (s)
+        # and retry deadband (mm), if it is one
+        self._tt_stage_velo      = backend.PV(tt_stage_record + '.VELO')
+        self._tt_stage_accl      = backend.PV(tt_stage_record + '.ACCL')
+        self._tt_stage_rdbd      = backend.PV(tt_stage_record + '.RDBD')
 
         self.tt_travel_offset    = 0.0
-        self.tt_fit_coeff        = np.array([ 0.0, 1.0, 0.0 ])
+        self.tt_fit_coeff        = np.array([ 0.0, 1.0, 0.0 ]) # see tt_fit_coeffs()
         self.calibrated          = False
 
+        # when a move counts as done, see _move()
+        self.delay_tolerance     = 1.0e-6 # ns
+        self.tt_stage_tolerance  = 1.0e-3 # mm, at least .RDBD, see tt_stage_settle_tolerance
+        self.settle_dwell        = 0.0    # s the value must stay in tolerance
+        self.settle_timeout      = 30.0   # s before a move is considered stuck
+        self.tt_window_tolerance = 300.0e-6 # ns, see tt_window
+
+        # for scan time estimates, see estimate_scan(). the TT stage motion
+        # is read from its motor record below, these are only fallbacks
+        self.tt_stage_velocity     = 1.0  # mm/s
+        self.tt_stage_acceleration = None # mm/s^2, None: instant
+        self.event_rate            = 120.0 # Hz
+        self.cycle_overhead        = 0.0  # s per timepoint, e.g. DAQ transitions
+        self.daq_poll_interval     = 0.01 # s, see _scan_pipelined()
+        self.daq_events_timeout    = 1.0  # s of slack for the events, see _scan_pipelined()
+        self._tt_stage_motion_read = False
+
+        # where to look for timetool calibrations, see load_calibration()
+        self.tt_calib_dir        = None
+        self.tt_detector_src     = None
+
         time.sleep(0.1) # time for PVs to connect
+        if default_tt_stage_rbv and not self._tt_stage_rbv.connected:
+            print "*** WARNING: no %s, the TT stage is not a motor record: TT " \
+                  "stage moves are NOT waited for" % tt_stage_readback_pv_name
+            self._tt_stage_rbv = self._tt_stage_position
         for pv in [self._laser_delay, self._tt_stage_position,
-                   self._t0, self._laser_lock]:
+                   self._t0, self._laser_lock,
+                   self._laser_delay_rbv, self._tt_stage_rbv]:
             if not pv.connected:
                 raise RuntimeError('Cannot connect to PV: %s' % pv.pvname)
+
+        self._tt_stage_motion_read = self.read_tt_stage_motion()
+        if not self._tt_stage_motion_read:
+            print "*** WARNING: cannot read the TT stage speed from %s.VELO/.ACCL, " \
+                  "scan time estimates use tt_stage_velocity/acceleration as set " \
+                  "(rc file or defaults)" % tt_stage_record
         
         return
 
 
+    def read_tt_stage_motion(self):
+        """
+        Set `tt_stage_velocity` and `tt_stage_acceleration` from the TT
+        stage motor record: .VELO (mm/s) and .ACCL (s to reach VELO, 0 for
+        instant).
+
+        Returns
+        -------
+        ok : bool
+            False (values unchanged) if the fields cannot be read.
+        """
+
+        if not (self._tt_stage_velo.connected and self._tt_stage_accl.connected):
+            return False
+        velo, accl = self._tt_stage_velo.value, self._tt_stage_accl.value
+        if (velo is None) or (accl is None) or (velo <= 0.0):
+            return False
+
+        self.tt_stage_velocity     = float(velo)
+        self.tt_stage_acceleration = float(velo) / accl if (accl > 0.0) else None
+
+        return True
+
+
+    @property
+    def tt_stage_settle_tolerance(self):
+        """
+        How close (mm) the TT stage readback has to get to its target: the
+        motor record stops anywhere within its retry deadband (.RDBD), so
+        never less than that, else `tt_stage_tolerance`.
+        """
+        if self._tt_stage_rdbd.connected and (self._tt_stage_rdbd.value is not None):
+            return max(self.tt_stage_tolerance, abs(float(self._tt_stage_rdbd.value)))
+        return self.tt_stage_tolerance
+
+
     @classmethod
-    def from_rc(cls, rc_path=None):
+    def from_rc(cls, rc_path=None, backend=None):
         """
         Create a Timescaner instance from a configuration saved in an rc
         file.
@@ -141,6 +406,8 @@ class Timescaner(object):
         -------------------
         rc_path : str
             The rc file to load. If `None`, will look for $HOME/.timescanrc
+        backend : object
+            See `__init__`.
 
         Returns
         -------
@@ -172,12 +439,31 @@ class Timescaner(object):
                        settings['laser_delay_pv_name'],
                        settings['tt_stage_position_pv_name'],
                        settings['t0_pv_name'],
-                       settings['laser_lock_pv_name'])
+                       settings['laser_lock_pv_name'],
+                       laser_delay_readback_pv_name=settings.get('laser_delay_readback_pv_name'),
+                       tt_stage_readback_pv_name=settings.get('tt_stage_readback_pv_name'),
+                       backend=backend)
 
             inst.tt_travel_offset  = float(settings['tt_travel_offset'])
-            inst.tt_fit_coeff      = np.fromstring(settings['tt_fit_coeff'].strip('[]'), sep=' ')
+            inst.tt_fit_coeff      = tt_fit_coeffs(np.fromstring(settings['tt_fit_coeff'].strip('[]'), sep=' '))
             inst.calibrated        = bool(settings['calibrated'])
 
+            # optional
+            inst.tt_calib_dir      = settings.get('tt_calib_dir')
+            inst.tt_detector_src   = settings.get('tt_detector_src')
+            if 'event_rate' in settings:
+                inst.event_rate     = float(settings['event_rate'])
+            if 'cycle_overhead' in settings:
+                inst.cycle_overhead = float(settings['cycle_overhead'])
+
+            # the motor record is the authority, the saved values are used
+            # if it cannot be read
+            if not inst._tt_stage_motion_read:
+                if 'tt_stage_velocity' in settings:
+                    inst.tt_stage_velocity = float(settings['tt_stage_velocity'])
+                if 'tt_stage_acceleration' in settings:
+                    inst.tt_stage_acceleration = float(settings['tt_stage_acceleration'])
+
 
         except KeyError as e:
             raise IOError(str(e) + ' key missing in timescanrc file!')
@@ -212,10 +498,21 @@ class Timescaner(object):
                     'tt_stage_position_pv_name' : self._tt_stage_position.pvname,
                     't0_pv_name'                : self._t0.pvname,
                     'laser_lock_pv_name'        : self._laser_lock.pvname,
+                    'laser_delay_readback_pv_name' : self._laser_delay_rbv.pvname,
+                    'tt_stage_readback_pv_name'    : self._tt_stage_rbv.pvname,
                     'tt_travel_offset'          : self.tt_travel_offset,
                     'tt_fit_coeff'              : self.tt_fit_coeff,
-                    'calibrated'                : self.calibrated
+                    'calibrated'                : self.calibrated,
+                    'tt_stage_velocity'         : self.tt_stage_velocity,
+                    'event_rate'                : self.event_rate,
+                    'cycle_overhead'            : self.cycle_overhead
                    }
+        if self.tt_stage_acceleration is not None:
+            settings['tt_stage_acceleration'] = self.tt_stage_acceleration
+        if self.tt_calib_dir is not None:
+            settings['tt_calib_dir'] = self.tt_calib_dir
+        if self.tt_detector_src is not None:
+            settings['tt_detector_src'] = self.tt_detector_src
 
         if rc_path is None:
             rc_path = os.path.join(os.environ['HOME'], '.timescanrc')
@@ -227,6 +524,60 @@ class Timescaner(object):
         return
 
         
+    def load_calibration(self, run, calib_dir=None, detector_src=None):
+        """
+        Set the timetool calibration (`tt_fit_coeff`) to the one valid for
+        `run` in the psconst calib store, as written by ts.calibrun.
+
+        Parameters
+        ----------
+        run : int
+            The run number.
+
+        Optional Parameters
+        -------------------
+        calib_dir : str
+            The calib directory, defaults to `tt_calib_dir`.
+        detector_src : str
+            The timetool source (e.g. CXI:TTSPEC), defaults to
+            `tt_detector_src`.
+
+        Returns
+        -------
+        calib : dict
+            The calibration, see `calibration.load_calibration`.
+
+        Raises
+        ------
+        ValueError
+            If the calibration is not a fit of the delay in ns of order
+            <= 2, see `tt_fit_coeffs`.
+        """
+
+        if calib_dir is None:
+            calib_dir = self.tt_calib_dir
+        if detector_src is None:
+            detector_src = self.tt_detector_src
+        if (calib_dir is None) or (detector_src is None):
+            raise ValueError('no calib dir/timetool source set, pass them or '
+                             'add tt_calib_dir/tt_detector_src to the rc file')
+
+        # not needed for scanning, keep h5py/psconst off the DAQ host's imports
+        from timescans import calibration
+
+        calib = calibration.load_calibration(calib_dir, detector_src, run)
+        units = calib.get('delay_units', 'ns')
+        if units != 'ns':
+            raise ValueError('timetool calibration %s fits the delay in %s, '
+                             'expected ns' % (calib['path'], units))
+        self.tt_fit_coeff = tt_fit_coeffs(calib['fit_coeff'])
+        self.calibrated   = True
+
+        print "timetool calibration: %s" % calib['path']
+
+        return calib
+
+        
     @property
     def tt_window(self):
         """
@@ -236,17 +587,18 @@ class Timescaner(object):
 
         # currently let's just say +/- 300 fs, to be replaced --TJL
         # could be fancy and take an error tol arg, etc etc
-        mm_travel = self._tt_stage_position.value
+        mm_travel = self._tt_stage_rbv.value
         print '^^^^^^^', mm_travel- self.tt_travel_offset
         delay_in_ns = mm_to_ns(mm_travel - self.tt_travel_offset)
-        window = (delay_in_ns - 300.0e-6, delay_in_ns + 300.0e-6)
+        window = (delay_in_ns - self.tt_window_tolerance,
+                  delay_in_ns + self.tt_window_tolerance)
 
         return window
         
         
     @property
     def current_delay(self):
-        delay = self._laser_delay.value
+        delay = self._laser_delay_rbv.value
         window = self.tt_window
         if (delay < window[0]) or (delay > window[1]):
             print "*** WARNING: TT stage out of range for delay!"
@@ -264,8 +616,8 @@ class Timescaner(object):
             Value to set delay to.
         """
 
-        old_delay = self._laser_delay.value
-        old_tt_pos = self._tt_stage_position.value
+        old_delay = self._laser_delay_rbv.value
+        old_tt_pos = self._tt_stage_rbv.value
 
         tt_pos = self._tt_pos_for_delay(delay_in_ns)
 
@@ -278,6 +630,33 @@ class Timescaner(object):
         return
 
 
+    def _move(self, moves):
+        """
+        Put new values to several PVs at once, and wait until their
+        readbacks have all settled (see PVSettleWaiter).
+
+        Parameters
+        ----------
+        moves : list of (epics.PV, epics.PV, float, float)
+            The PVs to put to, the PVs to watch (readbacks), the new values
+            and tolerances.
+
+        Raises
+        ------
+        RuntimeError
+            If the PVs do not settle within `settle_timeout`.
+        """
+
+        waiters = self._start_move(moves)
+        try:
+            wait_for_settle(waiters, self.settle_timeout)
+        finally:
+            for w in waiters:
+                w.close()
+
+        return
+
+
     def _tt_pos_for_delay(self, delay_in_ns):
 
         # TT delay stage doubles path length
@@ -287,7 +666,7 @@ class Timescaner(object):
         return tt_position
         
         
-    def calibrate(self):
+    def calibrate(self, pipelined=False):
         """
         Calibrate the pixel-to-fs conversion.
 
@@ -299,6 +678,11 @@ class Timescaner(object):
         NOTE 1/22/16, TJL
         >> the part about config the DAQ and psana is currently a lie, coming
            soon
+
+        Parameters
+        ----------
+        pipelined : bool
+            Overlap stage motion with the DAQ, see `scan_times`.
         """
 
         print ""
@@ -308,7 +692,8 @@ class Timescaner(object):
         # 120 evts/pt | -1 ps to 1 ps, 100 fs window
         times_in_ns = np.linspace(-0.001, 0.001, 41)
 
-        self.scan_times(times_in_ns, nevents_per_timestep=120, move_timetool=False)
+        self.scan_times(times_in_ns, nevents_per_timestep=120, move_timetool=False,
+                        pipelined=pipelined)
 
         # >>> now fit the calibration
         #     if we can launch an external process...
@@ -345,7 +730,7 @@ class Timescaner(object):
 
 
     def scan_range(self, t1, t2, resolution, nevents_per_timestep=100,
-                   randomize=False, repeats=1):
+                   randomize=False, repeats=1, pipelined=False):
         """
         Scan a range of equally spaced timepoints.
 
@@ -364,12 +749,16 @@ class Timescaner(object):
         nevents_per_timestep : int
             The number of shots to take at each timestep.
 
-        randomize : bool
+        randomize : bool or str
             If `True`, the order in which the timepoints are visited will be
             randomized. Useful for avoiding systematic errors due to drift.
+            See `scan_times` for the travel-bounded orderings.
 
         repeats : int
             The number of times to repeat the scan.
+
+        pipelined : bool
+            Overlap stage motion with the DAQ, see `scan_times`.
         """
 
         times = np.arange(t1, t2 + resolution, resolution)
@@ -379,13 +768,14 @@ class Timescaner(object):
                                                                           resolution,
                                                                           nevents_per_timestep )
         self.scan_times(times, nevents_per_timestep=nevents_per_timestep,
-                        randomize=randomize, repeats=repeats)
+                        randomize=randomize, repeats=repeats, pipelined=pipelined)
  
         return
 
 
     def scan_times(self, times_in_ns, nevents_per_timestep=100,
-                   randomize=False, repeats=1, record=True, move_timetool=True):
+                   randomize=False, repeats=1, record=True, move_timetool=True,
+                   pipelined=False):
         """
         Scan a list of specific time points, `times_in_ns`.
 
@@ -401,23 +791,45 @@ class Timescaner(object):
         nevents_per_timestep : int
             The number of events to measure at each timepoint
 
-        randomize : bool
+        randomize : bool or str
             If true, the order in which the timepoints are visited will be
-            randomly scrambled (good for removing systematic errors)
+            randomly scrambled (good for removing systematic errors). `True`
+            shuffles all the timepoints, 'blocked' or 'sweep' give orders
+            that are still randomized but bound the TT stage travel (see
+            timescans.scheduling)
 
         repeats : int
             How many times to repeat each timepoint
+
+        pipelined : bool
+            If true, each move is started as soon as the DAQ has the events
+            of the previous timepoint, overlapping with the end of its calib
+            cycle, and the TT stage only has to be within its window (see
+            `_scan_pipelined`). This relies on daq.eventnum() counting the
+            events of the run as they are taken: a DAQ without eventnum()
+            is scanned sequentially, and one whose count does not reach the
+            events of a timepoint falls back to sequential moves.
         """
 
         print ""
         print "="*40
         print "SCAN REQUESTED\n"
 
+        if pipelined and not hasattr(self.daq, 'eventnum'):
+            print "*** WARNING: the DAQ has no eventnum(), scanning sequentially"
+            pipelined = False
+
         if (record is False) or DEBUG:
             print "*** WARNING: not recording!"
 
         #times_in_ns = np.repeat(times_in_ns, repeats)
-        times_in_ns = np.tile(times_in_ns, repeats)
+        if randomize:
+            method = 'shuffle' if (randomize is True) else randomize
+            print "> randomizing timepoints (%s)" % method
+            times_in_ns = scheduling.order_timepoints(times_in_ns, repeats=repeats,
+                                                      method=method)
+        else:
+            times_in_ns = np.tile(times_in_ns, repeats)
         print "> scanning %d timepoints, %d events per timepoint" % (len(times_in_ns),
                                                                    nevents_per_timestep)
 
@@ -440,54 +852,229 @@ class Timescaner(object):
         self.daq.configure(**daq_config)
         print "> daq configured"
 
-        if randomize:
-            print "> randomizing timepoints"
-            np.random.shuffle(times_in_ns) # in-place
+        # the stage speed may have been changed since we connected
+        self.read_tt_stage_motion()
+        estimate = self.estimate_scan(times_in_ns, nevents_per_timestep,
+                                      move_timetool=move_timetool)
+        print "> expected: TT stage travel %.2f mm, ~%.0f s moving, ~%.0f s total" \
+              % (estimate['travel'], estimate['move_time'], estimate['total_time'])
+
+        if pipelined:
+            try:
+                rn = self._scan_pipelined(times_in_ns, nevents_per_timestep, move_timetool)
+            finally:
+                self.daq.disconnect()
+                print "> finished, daq released" 
+            return rn
 
+        tt_tolerance = self.tt_stage_settle_tolerance
+        rn = None
+        done = False
         t0 = time.time()
-        for cycle, delay in enumerate(times_in_ns):
+        try:
+            for cycle, delay in enumerate(times_in_ns):
 
-            new_tt_pos = self._tt_pos_for_delay(delay)
-            print " --> cycle %d / laser delay %f ns / tt stage: %f" % (cycle, delay, new_tt_pos)
-           
-            if not DEBUG: 
-                self._laser_delay.put(delay)
-                if move_timetool:
-                    self._tt_stage_position.put(new_tt_pos)
+                new_tt_pos = self._tt_pos_for_delay(delay)
+                print " --> cycle %d / laser delay %f ns / tt stage: %f" % (cycle, delay, new_tt_pos)
+
+                if not DEBUG: 
+                    # move, and wait until PVs reach the value we want
+                    # (raises if a stage is stuck)
+                    moves = [ (self._laser_delay, self._laser_delay_rbv, delay,
+                               self.delay_tolerance) ]
+                    if move_timetool:
+                        moves.append( (self._tt_stage_position, self._tt_stage_rbv,
+                                       new_tt_pos, tt_tolerance) )
+                    self._move(moves)
 
-                # wait until PVs reach the value we want
-                while (np.abs(self._laser_delay.value - delay) > 1e-9 ):
-                    time.sleep(0.001)
                 if move_timetool:
-                    while (np.abs(self._tt_stage_position.value - new_tt_pos) > 1e-9):
-                        time.sleep(0.001)
-           
-            if move_timetool:
-                ctrls = [( self._laser_delay.pvname,       delay ),
-                         ( self._tt_stage_position.pvname, new_tt_pos )]
-            else:
-                ctrls = [( self._laser_delay.pvname, delay ) ]
+                    ctrls = [( self._laser_delay.pvname,       delay ),
+                             ( self._tt_stage_position.pvname, new_tt_pos )]
+                else:
+                    ctrls = [( self._laser_delay.pvname, delay ) ]
 
-            try:
                 self.daq.begin(controls=ctrls)
                 self.daq.end()
                 rn = self.daq.runnumber()
-            except KeyboardInterrupt:
-                print 'Rcv crtl-C, interrupting DAQ scan'
-                self.daq.disconnect()
+
+                t = time.time()
+                #print 'cycle time:', t-t0
+                t0 = t
+
+            done = True
+
+        except KeyboardInterrupt:
+            print 'Rcv crtl-C, interrupting DAQ scan'
+
+        finally:
+            # never leave the DAQ configured and held by this client
+            if not done:
                 self.daq.stop()
+            self.daq.disconnect()
+            print "> finished, daq released" 
+
+        return rn
+
+
+    def _start_move(self, moves):
+        """
+        Put new values to several PVs at once, without waiting. Returns
+        the PVSettleWaiters (on the readbacks) to pass to `wait_for_settle`,
+        see `_move`. A PV that is its own readback (no readback PV
+        configured) would "settle" as soon as it is put, so it is not
+        waited on at all.
+        """
+        waiters = [ PVSettleWaiter(rbv, value, tol, dwell=self.settle_dwell)
+                    for pv, rbv, value, tol in moves if rbv is not pv ]
+        for pv, rbv, value, tol in moves:
+            pv.put(value)
+        return waiters
+
+
+    def _wait_for_events(self, n_events, timeout):
+        """
+        Poll `daq.eventnum()` until it reaches `n_events`, every
+        `daq_poll_interval` seconds.
+
+        Returns
+        -------
+        reached : bool
+            False if it did not within `timeout` seconds.
+        """
+
+        deadline = time.time() + timeout
+        while self.daq.eventnum() < n_events:
+            if time.time() >= deadline:
+                return False
+            time.sleep(self.daq_poll_interval)
+
+        return True
+
+
+    def _scan_pipelined(self, times_in_ns, nevents_per_timestep, move_timetool):
+        """
+        Scan the (already configured) DAQ over `times_in_ns`, overlapping
+        stage motion with the DAQ:
+
+        -- the (delay, tt stage) schedule is computed up front
+        -- after each daq.begin(), daq.eventnum() is polled until the DAQ
+           has the events for the current timepoint, then the move to the
+           next one is started and daq.end() closes the calib cycle while
+           the stages move. The DAQ is only used from this thread. The
+           poll gives up after twice the expected acquisition time (plus
+           `daq_events_timeout`), e.g. if the DAQ stalls or counts events
+           differently: the rest of the scan then moves only after
+           daq.end(), as a sequential scan does
+        -- before each daq.begin(), the laser delay has to be settled and
+           the TT stage readback only has to be inside the TT window
+           (`tt_window_tolerance`), not at its exact position
+        """
+
+        schedule = [ (delay, self._tt_pos_for_delay(delay)) for delay in times_in_ns ]
+        tt_tolerance = max(self.tt_stage_settle_tolerance,
+                           ns_to_mm(self.tt_window_tolerance) / 2.0)
+        events_timeout = 2.0 * nevents_per_timestep / self.event_rate + self.daq_events_timeout
+        overlap = True
+
+        def start_move(delay, tt_pos):
+            if DEBUG:
+                return []
+            moves = [ (self._laser_delay, self._laser_delay_rbv, delay,
+                       self.delay_tolerance) ]
+            if move_timetool:
+                moves.append( (self._tt_stage_position, self._tt_stage_rbv,
+                               tt_pos, tt_tolerance) )
+            return self._start_move(moves)
+
+        waiters = None # the move in progress, if any
+        rn = None
+        done = False
+
+        try:
+            for cycle, (delay, tt_pos) in enumerate(schedule):
+
+                print " --> cycle %d / laser delay %f ns / tt stage: %f" % (cycle, delay, tt_pos)
+
+                if waiters is None:
+                    waiters = start_move(delay, tt_pos)
+                try:
+                    wait_for_settle(waiters, self.settle_timeout)
+                finally:
+                    for w in waiters:
+                        w.close()
+                    waiters = None
+
+                if move_timetool:
+                    ctrls = [( self._laser_delay.pvname,       delay ),
+                             ( self._tt_stage_position.pvname, tt_pos )]
+                else:
+                    ctrls = [( self._laser_delay.pvname, delay ) ]
 
-            t = time.time()
-            #print 'cycle time:', t-t0
-            t0 = t
+                n_events = self.daq.eventnum() + nevents_per_timestep
+                self.daq.begin(controls=ctrls)
+                if overlap and (cycle + 1 < len(schedule)):
+                    if self._wait_for_events(n_events, events_timeout):
+                        waiters = start_move(*schedule[cycle+1])
+                    else:
+                        print "*** WARNING: daq.eventnum() did not reach %d within %.1f s, " \
+                              "moving after daq.end() from now on" % (n_events, events_timeout)
+                        overlap = False
+                self.daq.end()
+
+            rn = self.daq.runnumber()
+            done = True
 
+        except KeyboardInterrupt:
+            print 'Rcv crtl-C, interrupting DAQ scan'
 
-        self.daq.disconnect()
-        print "> finished, daq released" 
+        finally:
+            # no monitor callbacks left behind on any error
+            if waiters is not None:
+                for w in waiters:
+                    w.close()
+            if not done:
+                self.daq.stop()
 
         return rn
 
 
+    def estimate_scan(self, times_in_ns, nevents_per_timestep=100,
+                      move_timetool=True):
+        """
+        Estimate the TT stage travel and time a scan of `times_in_ns`, in
+        that order, will take. Uses `tt_stage_velocity`,
+        `tt_stage_acceleration` (see `read_tt_stage_motion`), `event_rate`
+        and `cycle_overhead`.
+
+        Parameters
+        ----------
+        times_in_ns : np.ndarray
+            The timepoints, in the order they will be visited.
+        nevents_per_timestep : int
+            The number of events measured at each timepoint.
+        move_timetool : bool
+            If false, the TT stage does not move (no travel).
+
+        Returns
+        -------
+        estimate : dict
+            'travel' (mm), 'move_time', 'acquire_time' and 'total_time' (s),
+            see scheduling.estimate_scan.
+        """
+
+        positions = np.array([ self._tt_pos_for_delay(t) for t in times_in_ns ])
+        if move_timetool:
+            start = self._tt_stage_rbv.value
+        else:
+            positions[:] = self._tt_stage_rbv.value
+            start = None
+
+        return scheduling.estimate_scan(positions, nevents_per_timestep,
+                                        self.event_rate, self.tt_stage_velocity,
+                                        acceleration=self.tt_stage_acceleration,
+                                        start=start, overhead=self.cycle_overhead)
+
+
     def _scan_back_and_forth(self, window_size_fs):
         
         set_delay = self._laser_delay.value
@@ -495,9 +1082,8 @@ class Timescaner(object):
             if not DEBUG:
                 delay = np.random.uniform(set_delay - window_size_fs/2.0 * 1e6,
                                           set_delay + window_size_fs/2.0 * 1e6)
-                self._laser_delay.put(delay)
-                while (np.abs(self._laser_delay.value - delay) > 1e-9):
-                    time.sleep(0.001)
+                self._move([ (self._laser_delay, self._laser_delay_rbv, delay,
+                              self.delay_tolerance) ])
             time.sleep(1.0) # give EPICs a 1 second break, may update this
                     
         return
@@ -1,10 +1,13 @@
 
 import os
+import json
+import h5py
 import numpy as np
-from matplotlib import pyplot as plt
 
+import psconst
 
-def fit_errors(x, y, y_hat, bin_size):
+
+def fit_errors(x, y, y_hat, bin_size, weights=None):
     """
     Compute errors for fit both 'locally' and 'globally'.
 
@@ -21,6 +24,10 @@ def fit_errors(x, y, y_hat, bin_size):
     bin_size : float
        The resolution in which to bin `x` for local error computation.
 
+    weights : np.ndarray
+       Optional, equal-length 1D array of weights for each point. If given,
+       all means, sums of squares and RMSEs are weighted.
+
 
     Returns
     -------
@@ -44,125 +51,1003 @@ def fit_errors(x, y, y_hat, bin_size):
     >>> plot(rmes[:,0],rmes[:,1] + rmes[:,2],'k-')
     """
 
-    ssq = lambda x : np.sum(np.square(x))
+    if weights is None:
+        weights = np.ones_like(x, dtype=np.float64)
+
+    sq_res = np.square(y - y_hat)
     
     # global R^2
-    ssres = ssq(y - y_hat)
-    sstot = ssq(y - np.mean(y))
+    ssres = np.dot(weights, sq_res)
+    sstot = np.dot(weights, np.square(y - np.average(y, weights=weights)))
     r_sq = 1.0 - ssres / sstot
     
-    # per-bin RME
+    # per-bin RME, one pass: sum everything per bin & keep non-empty bins
     bins = np.arange(x.min(), x.max()+bin_size*2, bin_size)
     assign = np.digitize(x, bins)
-    uq = np.unique(assign)
-    rmes = np.zeros((len(uq), 3))
-    
-    # get all x's that fall in a bin & compute rme
-    for i,u in enumerate(uq):
-        idx = (assign == u) # index of pts in bin
-        rmes[i,0] = np.mean(x[idx])
-        rmes[i,1] = np.mean(y_hat[idx])
-        rmes[i,2] = np.sqrt(ssq( y[idx] - y_hat[idx] ) / np.sum(idx) )
+
+    w_sum = np.bincount(assign, weights=weights)
+    occupied = np.bincount(assign) > 0
+    w_sum = w_sum[occupied]
+
+    rmes = np.zeros((w_sum.shape[0], 3))
+    rmes[:,0] = np.bincount(assign, weights=weights*x)[occupied] / w_sum
+    rmes[:,1] = np.bincount(assign, weights=weights*y_hat)[occupied] / w_sum
+    rmes[:,2] = np.sqrt(np.bincount(assign, weights=weights*sq_res)[occupied] / w_sum)
     
     return r_sq, rmes
 
 
-def analyze_calibration_run(exp, run, las_delay_pvname, px_cutoffs=(200, 800)):
+# default timetool fit quality cuts
+FWHM_RANGE    = (50.0, 250.0)
+MIN_AMPLITUDE = 0.03
+BLOCK_SIZE    = 10000 # events read before the cuts are applied
+
+CALIB_TYPE    = 'timetool' # psconst calib store: <calib dir>/timetool/<src>/
+
+
+class ColumnBuffer(object):
     """
-    Analyze a run where the timetool camera is fixed but the laser delay
-    changes by a known amount in order to calibrate the TT camera pixel-
-    time conversion.
+    A preallocated, growable 2D float array that rows are appended to.
     """
 
-    import psana
-    ds = psana.DataSource('exp=%s:run=%d:smd' % (exp, run))
+    def __init__(self, n_columns, capacity=BLOCK_SIZE):
+        self._data = np.empty((capacity, n_columns))
+        self.n = 0
+        return
 
 
-    las_dly = psana.Detector(las_delay_pvname, ds.env())
+    def __len__(self):
+        return self.n
 
-    if exp[:3] == 'cxi':
-        tt_edge = psana.Detector('CXI:TTSPEC:FLTPOS', ds.env())
-        tt_famp = psana.Detector('CXI:TTSPEC:AMPL', ds.env())
-        tt_fwhm = psana.Detector('CXI:TTSPEC:FLTPOSFWHM', ds.env())
-    elif exp[:3] == 'xpp':
-        tt_edge = psana.Detector('XPP:TIMETOOL:FLTPOS', ds.env())
-        tt_famp = psana.Detector('XPP:TIMETOOL:AMPL', ds.env())
-        tt_fwhm = psana.Detector('XPP:TIMETOOL:FLTPOSFWHM', ds.env())
 
-    delay_pxl_data = []
-    for i,evt in enumerate(ds.events()):
-        print "analyzing event: %d\r" % (i+1),
+    def _reserve(self, n):
+        if n > self._data.shape[0]:
+            new = np.empty((max(n, 2 * self._data.shape[0]), self._data.shape[1]))
+            new[:self.n] = self._data[:self.n]
+            self._data = new
+        return
 
-        # perform some checks on the fit amp and fwhm
-        if (tt_fwhm(evt) > 250.0) or (tt_fwhm(evt) < 50.0): continue
-        if (tt_famp(evt) < 0.03): continue
 
-        edge = tt_edge(evt)
-        if (px_cutoffs[0] <= edge) and (edge <= px_cutoffs[1]):
-            delay_pxl_data.append([ tt_edge(evt), las_dly(evt) ])
+    def append(self, row):
+        self._reserve(self.n + 1)
+        self._data[self.n] = row
+        self.n += 1
+        return
 
-        if i == 15000: break # debugging
 
-        
-    delay_pxl_data = np.array(delay_pxl_data)
-    print "Analyzing in-range %d events" % delay_pxl_data.shape[0]
+    def extend(self, rows):
+        self._reserve(self.n + rows.shape[0])
+        self._data[self.n:self.n + rows.shape[0]] = rows
+        self.n += rows.shape[0]
+        return
 
-    out_path = os.path.join(os.environ['HOME'], 
-                            'tt_calib_data_%s_r%d.txt' % (exp, run))
-    print "saving raw calibration data --> %s" % out_path
-    np.savetxt(out_path, delay_pxl_data)
 
+    def clear(self):
+        self.n = 0
+        return
+
+
+    @property
+    def data(self):
+        return self._data[:self.n]
+
+
+def apply_cuts(edge, amp, fwhm, px_cutoffs, fwhm_range=FWHM_RANGE,
+               min_amp=MIN_AMPLITUDE, delay=None, counts=None):
+    """
+    Select events with a good timetool fit, in the pixel range to calibrate.
+
+    The cuts are applied in order: missing data, FWHM, amplitude, edge
+    position. Each rejected event is counted against the first cut it
+    fails.
+
+    Parameters
+    ----------
+    edge, amp, fwhm : np.ndarray
+        The timetool edge position (pixels), amplitude and FWHM of each
+        event. NaN for missing values.
+    px_cutoffs : tuple
+        The (min, max) edge position to accept.
+    fwhm_range : tuple
+        The (min, max) FWHM to accept.
+    min_amp : float
+        The minimum amplitude to accept.
+    delay : np.ndarray
+        Optional, the laser delay of each event. Events where it is NaN are
+        counted as missing data.
+    counts : dict
+        If given, the number of events rejected by each cut ('missing',
+        'fwhm', 'amplitude', 'edge') and accepted ('accepted') are added
+        to it.
+
+    Returns
+    -------
+    accepted : np.ndarray (bool)
+        Which events pass all cuts.
+    """
+
+    with np.errstate(invalid='ignore'):
+        missing = ~(np.isfinite(edge) & np.isfinite(amp) & np.isfinite(fwhm))
+        if delay is not None:
+            missing |= ~np.isfinite(delay)
+        bad_fwhm = ~missing & ((fwhm > fwhm_range[1]) | (fwhm < fwhm_range[0]))
+        bad_amp = ~missing & ~bad_fwhm & (amp < min_amp)
+        in_range = (px_cutoffs[0] <= edge) & (edge <= px_cutoffs[1])
+
+    remaining = ~(missing | bad_fwhm | bad_amp)
+    bad_edge = remaining & ~in_range
+    accepted = remaining & in_range
+
+    if counts is not None:
+        for k, v in [('missing', missing), ('fwhm', bad_fwhm), ('amplitude', bad_amp),
+                     ('edge', bad_edge), ('accepted', accepted)]:
+            counts[k] = counts.get(k, 0) + int(np.sum(v))
+
+    return accepted
+
+
+class PolyfitMoments(object):
+    """
+    Mergeable sufficient statistics for a least-squares polynomial fit of
+    y(x), plus binned statistics to compute the fit errors afterwards.
+
+    Per bin of x, the sums of t^k (k <= 2 * order), t^k * y (k <= order) and
+    y^2 are kept, where t = (x - x0) / scale is x mapped to [-1, 1] over
+    `x_range` (this keeps the normal equations well conditioned). The state
+    is a plain sum: partial results, e.g. from MPI ranks, are combined by
+    adding them.
+
+    Example
+    -------
+    >>> m = PolyfitMoments(order=2, x_range=(200, 800), bin_size=50)
+    >>> m.update(edges, delays)
+    >>> fit = m.solve()              # like np.polyfit(edges, delays, 2)
+    >>> r_sq, rmes = m.fit_errors(fit) # like fit_errors(...)
+    """
+
+    def __init__(self, order=2, x_range=(200, 800), bin_size=50):
+        """
+        Parameters
+        ----------
+        order : int
+            The polynomial order.
+        x_range : tuple
+            The (min, max) x values that will be added.
+        bin_size : float
+            The resolution in which to bin x for local error computation.
+        """
+
+        self.order = order
+        self.x0 = 0.5 * (x_range[1] + x_range[0])
+        self.scale = 0.5 * (x_range[1] - x_range[0])
+        self.bins = np.arange(x_range[0], x_range[1] + bin_size, bin_size)
+
+        # columns: t^0 ... t^2k | t^0 y ... t^k y | y^2
+        self.state = np.zeros((self.bins.shape[0] + 1, 3 * order + 3))
+
+        return
+
+
+    @property
+    def n(self):
+        return self.state[:,0].sum()
+
+
+    def update(self, x, y):
+        """
+        Add (x, y) points.
+        """
+
+        t = (np.asarray(x) - self.x0) / self.scale
+        assign = np.clip(np.digitize(x, self.bins), 0, self.state.shape[0] - 1)
+        n_cells = self.state.shape[0]
+
+        t_k = np.ones_like(t)
+        for k in range(2 * self.order + 1):
+            self.state[:,k] += np.bincount(assign, weights=t_k, minlength=n_cells)
+            if k <= self.order:
+                self.state[:,2*self.order+1+k] += np.bincount(assign, weights=t_k*y,
+                                                              minlength=n_cells)
+            t_k = t_k * t
+        self.state[:,-1] += np.bincount(assign, weights=np.square(y), minlength=n_cells)
+
+        return
+
+
+    def merge(self, other):
+        if other.state.shape != self.state.shape:
+            raise ValueError('cannot merge moments of different shape')
+        if (other.x0, other.scale) != (self.x0, self.scale):
+            raise ValueError('cannot merge moments over different x ranges')
+        self.state += other.state
+        return self
+
+
+    def _normal_equations(self, sums):
+        k = self.order + 1
+        idx = np.arange(k)
+        A = sums[idx[:,None] + idx[None,:]]
+        b = sums[2*self.order+1:2*self.order+1+k]
+        return A, b
+
+
+    def solve(self):
+        """
+        Solve the least-squares problem.
+
+        Returns
+        -------
+        fit : np.ndarray
+            The polynomial coefficients in x, highest power first (as
+            returned by np.polyfit).
+        """
+
+        A, b = self._normal_equations(self.state.sum(axis=0))
+        coef_t = np.linalg.solve(A, b)
+
+        # p(t), t = (x - x0) / scale --> p(x)
+        p = np.poly1d(coef_t[::-1])(np.poly1d([1.0 / self.scale, -self.x0 / self.scale]))
+
+        return np.atleast_1d(p.coeffs)
+
+
+    def fit_errors(self, fit):
+        """
+        R^2 and per-bin RMSEs of a polynomial fit, as `fit_errors`, but from
+        the accumulated sums.
+
+        Parameters
+        ----------
+        fit : np.ndarray
+            The polynomial coefficients in x, highest power first.
+
+        Returns
+        -------
+        r_sq : float
+            The usual R^2 statistic.
+
+        rmes : np.ndarray
+            A 2D array of local errors, see `fit_errors`.
+        """
+
+        # coefficients in t, lowest power first
+        p_t = np.poly1d(fit)(np.poly1d([self.scale, self.x0]))
+        c = np.zeros(self.order + 1)
+        c[:len(p_t.coeffs)] = p_t.coeffs[::-1]
+
+        def ssres_and_mean(sums):
+            A, b = self._normal_equations(sums)
+            ssres = sums[-1] - 2.0 * np.dot(c, b) + np.dot(c, np.dot(A, c))
+            mean_y_hat = np.dot(c, sums[:self.order+1]) / sums[0]
+            return max(ssres, 0.0), mean_y_hat
+
+        total = self.state.sum(axis=0)
+        n = total[0]
+        ssres, _ = ssres_and_mean(total)
+        sstot = total[-1] - np.square(total[2*self.order+1]) / n
+        r_sq = 1.0 - ssres / sstot
+
+        occupied = np.where(self.state[:,0] > 0)[0]
+        rmes = np.zeros((len(occupied), 3))
+        for i, j in enumerate(occupied): # loop over bins, not points
+            sums = self.state[j]
+            ssres_j, mean_y_hat = ssres_and_mean(sums)
+            rmes[i,0] = self.x0 + self.scale * sums[1] / sums[0]
+            rmes[i,1] = mean_y_hat
+            rmes[i,2] = np.sqrt(ssres_j / sums[0])
+
+        return r_sq, rmes
+
+
+def _t_to_x(order, x0, scale):
+    """
+    Matrix T st. T.dot(c_t) are the polynomial coefficients in x (highest
+    power first) of the polynomial with coefficients c_t (lowest power
+    first) in t = (x - x0) / scale.
+    """
+    t = np.poly1d([1.0 / scale, -x0 / scale])
+    T = np.zeros((order + 1, order + 1))
+    for k in range(order + 1):
+        coeffs = (t ** k).coeffs
+        T[order+1-len(coeffs):,k] = coeffs
+    return T
+
+
+def _robust_weights(r, method, n_sigma):
+    """
+    IRLS weights for residuals `r`, with a robust (MAD) estimate of their
+    scale.
+    """
+
+    sigma = 1.4826 * np.median(np.abs(r - np.median(r)))
+    if sigma == 0.0:
+        return np.ones_like(r)
+    u = r / (n_sigma * sigma)
+
+    if method == 'clip':
+        w = (np.abs(u) < 1.0).astype(np.float64)
+    elif method == 'biweight':
+        w = np.square(np.clip(1.0 - np.square(u), 0.0, None))
+    elif method == 'huber':
+        w = np.minimum(1.0, 1.0 / np.maximum(np.abs(u), 1e-300))
+    else:
+        raise ValueError('unknown robust fit method: %s' % method)
+
+    return w
+
+
+def robust_polyfit(x, y, order=2, method='biweight', n_sigma=4.685,
+                   max_iter=20, tol=1e-6):
+    """
+    Fit a polynomial y(x), down-weighting outliers by iteratively
+    reweighted least squares.
+
+    Each iteration is one weighted least-squares solve over all points
+    (O(n)). The residual scale is estimated robustly (median absolute
+    deviation) at each iteration, so no cut values need tuning.
+
+    Parameters
+    ----------
+    x, y : np.ndarray
+        Equal-length 1D arrays of the data.
+    order : int
+        The polynomial order.
+    method : str
+        'biweight' (Tukey), 'huber' or 'clip' (sigma-clipping).
+    n_sigma : float
+        The residual, in units of the robust sigma, where the weights start
+        to fall (huber), become zero (biweight) or the points are clipped
+        (clip). Use e.g. 4.685 for biweight, 1.345 for huber, 3 for clip.
+    max_iter : int
+        The maximum number of reweighting passes.
+    tol : float
+        Stop when the coefficients change less than this (relative).
+
+    Returns
+    -------
+    fit : np.ndarray
+        The polynomial coefficients, highest power first (as np.polyfit).
+    weights : np.ndarray
+        The final weight of each point, in [0, 1].
+    n_iter : int
+        The number of passes made.
+    """
+
+    x0 = 0.5 * (x.max() + x.min())
+    scale = max(0.5 * (x.max() - x.min()), 1e-300)
+    V = np.vander((x - x0) / scale, order + 1, increasing=True)
+
+    w = np.ones_like(y, dtype=np.float64)
+    c_t = None
+    for n_iter in range(1, max_iter + 1):
+        Vw = V * w[:,None]
+        c_new = np.linalg.solve(np.dot(Vw.T, V), np.dot(Vw.T, y))
+        converged = (c_t is not None) and \
+                    np.all(np.abs(c_new - c_t) <= tol * np.maximum(np.abs(c_new), 1e-300))
+        c_t = c_new
+        if converged:
+            break
+        w = _robust_weights(y - np.dot(V, c_t), method, n_sigma)
+
+    fit = np.dot(_t_to_x(order, x0, scale), c_t)
+
+    return fit, w, n_iter
+
+
+def bootstrap_polyfit(x, y, order=2, weights=None, n_boot=1000, ci=0.95,
+                      max_batch_elements=2**24, random_state=None):
+    """
+    Bootstrap confidence intervals for the coefficients of a (weighted)
+    least-squares polynomial fit.
+
+    Resamples are drawn in batches as index matrices. These are turned into
+    per-resample point counts, so each batch of fits is one matrix product
+    and a stacked solve of the normal equations. Pass the `weights` from
+    `robust_polyfit` to bootstrap the robust fit (with the weights held
+    fixed).
+
+    Parameters
+    ----------
+    x, y : np.ndarray
+        Equal-length 1D arrays of the data.
+    order : int
+        The polynomial order.
+    weights : np.ndarray
+        Optional per-point weights.
+    n_boot : int
+        The number of bootstrap resamples.
+    ci : float
+        The confidence level of the returned interval.
+    max_batch_elements : int
+        Bounds the memory use: batch size x number of points.
+    random_state : np.random.RandomState
+        Optional source of randomness.
+
+    Returns
+    -------
+    interval : np.ndarray
+        A (2, order+1) array, the lower and upper bound of each coefficient
+        (highest power first).
+    samples : np.ndarray
+        The (n_boot, order+1) bootstrap coefficients.
+    """
+
+    if random_state is None:
+        random_state = np.random.RandomState()
+    if weights is None:
+        weights = np.ones_like(y, dtype=np.float64)
+
+    n = x.shape[0]
+    x0 = 0.5 * (x.max() + x.min())
+    scale = max(0.5 * (x.max() - x.min()), 1e-300)
+    V = np.vander((x - x0) / scale, order + 1, increasing=True)
+
+    # per-point terms of the normal equations: w t^(j+k) and w t^k y
+    k = order + 1
+    jk = np.arange(k)[:,None] + np.arange(k)[None,:]
+    T2 = np.vander((x - x0) / scale, 2 * order + 1, increasing=True) * weights[:,None]
+    M = np.hstack([ T2, V * (weights * y)[:,None] ])
+
+    batch_size = int(max(1, min(n_boot, max_batch_elements // n)))
+    samples_t = np.zeros((n_boot, k))
+
+    for start in range(0, n_boot, batch_size):
+        b = min(batch_size, n_boot - start)
+        idx = random_state.randint(0, n, size=(b, n))
+        counts = np.bincount((idx + n * np.arange(b)[:,None]).ravel(),
+                             minlength=b*n).reshape(b, n)
+        sums = np.dot(counts, M)                # (b, 3 * order + 2)
+        A = sums[:,jk]                          # (b, k, k)
+        rhs = sums[:,2*order+1:]                # (b, k)
+        samples_t[start:start+b] = np.linalg.solve(A, rhs[:,:,None])[:,:,0]
+
+    samples = np.dot(samples_t, _t_to_x(order, x0, scale).T)
+    alpha = 100.0 * (1.0 - ci) / 2.0
+    interval = np.percentile(samples, [alpha, 100.0 - alpha], axis=0)
+
+    return interval, samples
+
+
+def _value(x):
+    """ detectors return None for missing data """
+    return np.nan if x is None else x
+
+
+def plot_calibration(ax, fit, rmes, x_range, las_delay_pvname,
+                     delay_pxl_data=None):
+    """
+    Draw the calibration data (as a 2D histogram), fit and +/- 3 sigma
+    bands on a matplotlib Axes.
+    """
 
-    # from docs >> fs_result = a + b*x + c*x^2, x is edge position
-    fit = np.polyfit(delay_pxl_data[:,0], delay_pxl_data[:,1], 2)
-    c, b, a = fit * 1000.0
     p = np.poly1d(fit)
 
-    r_sq, rmes = fit_errors(delay_pxl_data[:,0], delay_pxl_data[:,1], 
-                            p(delay_pxl_data[:,0]), 50)
+    if delay_pxl_data is not None:
+        counts, x_edges, y_edges = np.histogram2d(delay_pxl_data[:,0], delay_pxl_data[:,1],
+                                                  bins=(256, 200))
+        ax.pcolormesh(x_edges, y_edges, np.log1p(counts.T), cmap='Greys')
+
+    x = np.linspace(x_range[0], x_range[1], 101)
+    ax.plot(x, p(x), 'r-', label='fit')
+    ax.plot(rmes[:,0], rmes[:,1] - rmes[:,2]*3, 'k-', label='-3 $\sigma$')
+    ax.plot(rmes[:,0], rmes[:,1] + rmes[:,2]*3, 'k-', label='+3 $\sigma$')
+    ax.legend()
+    ax.set_xlabel('Edge Position (pixels) [TTSPEC:FLTPOS]')
+    ax.set_ylabel('Laser Delay (ps) [%s]' % las_delay_pvname)
+    ax.set_xlim([0, 1024])
+
+    return
+
+
+def write_report(base_path, summary, fit, rmes, x_range, las_delay_pvname,
+                 delay_pxl_data=None):
+    """
+    Write a calibration report without any GUI: `<base_path>.png`, drawn
+    with the Agg backend (pyplot is never imported), and a JSON summary
+    `<base_path>.json`.
+
+    Parameters
+    ----------
+    base_path : str
+        The report file paths, without extension.
+    summary : dict
+        JSON-serializable fit results to save.
+    fit, rmes, x_range, las_delay_pvname, delay_pxl_data
+        See `plot_calibration`.
+
+    Returns
+    -------
+    png_path, json_path : str
+        The files written.
+    """
+
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=(8, 6))
+    FigureCanvasAgg(fig)
+    plot_calibration(fig.add_subplot(111), fit, rmes, x_range, las_delay_pvname,
+                     delay_pxl_data=delay_pxl_data)
+
+    png_path = base_path + '.png'
+    fig.savefig(png_path, dpi=100)
+
+    json_path = base_path + '.json'
+    with open(json_path, 'w') as f:
+        json.dump(summary, f, indent=2, sort_keys=True)
+
+    return png_path, json_path
+
+
+def save_calibration_data(path, delay_pxl_data, metadata):
+    """
+    Save raw (edge, delay) calibration pairs to HDF5, in an uncompressed,
+    contiguous dataset (so it can be memory-mapped), with `metadata`
+    (cut parameters, PV names, ...) as attributes.
+    """
+
+    with h5py.File(path, 'w') as f:
+        f.create_dataset('delay_pxl', data=np.ascontiguousarray(delay_pxl_data,
+                                                                dtype=np.float64))
+        for k, v in metadata.items():
+            f.attrs[k] = v
+
+    return
+
+
+def _attr_value(v):
+    """ HDF5 attributes come back as numpy types, make them JSON friendly """
+    if isinstance(v, np.ndarray):
+        return v.tolist()
+    elif isinstance(v, np.generic):
+        return v.item()
+    elif isinstance(v, bytes) and not isinstance(v, str):
+        return v.decode('utf-8')
+    return v
+
+
+def load_calibration_data(path, mmap=True):
+    """
+    Load raw calibration data written by `save_calibration_data`.
+
+    Parameters
+    ----------
+    path : str
+        The HDF5 file.
+    mmap : bool
+        If `True` (and the dataset is contiguous), the data are
+        memory-mapped read-only rather than read.
+
+    Returns
+    -------
+    delay_pxl_data : np.ndarray
+        An (N, 2) array of (edge position, laser delay).
+    metadata : dict
+        The saved attributes.
+    """
+
+    with h5py.File(path, 'r') as f:
+        ds = f['delay_pxl']
+        metadata = dict([ (k, _attr_value(v)) for k, v in f.attrs.items() ])
+        offset = ds.id.get_offset() if (ds.chunks is None) else None
+        if (not mmap) or (offset is None) or (ds.size == 0):
+            return ds[...], metadata
+        shape, dtype = ds.shape, ds.dtype
+
+    return np.memmap(path, mode='r', dtype=dtype, offset=offset, shape=shape), metadata
+
+
+def fit_calibration(delay_pxl_data, px_cutoffs=(200, 800), order=2, robust=True,
+                    n_bootstrap=200):
+    """
+    Fit the delay as a polynomial of the edge position.
+
+    Parameters
+    ----------
+    delay_pxl_data : np.ndarray
+        An (N, 2) array of (edge position, laser delay), events outside
+        `px_cutoffs` are ignored.
+    px_cutoffs : tuple
+        The (min, max) edge position to fit.
+    order : int
+        The polynomial order.
+    robust : bool
+        Use `robust_polyfit` (Tukey biweight) rather than np.polyfit.
+    n_bootstrap : int
+        The number of bootstrap resamples for confidence intervals (0 for
+        none).
+
+    Returns
+    -------
+    results : dict
+        'fit' (np.polyfit order), 'interval' (2, order+1 or None), 'r_sq',
+        'rmes' (see `fit_errors`), 'x_range', 'n_events' and 'data' (the
+        in-range events).
+    """
+
+    in_range = (px_cutoffs[0] <= delay_pxl_data[:,0]) & (delay_pxl_data[:,0] <= px_cutoffs[1])
+    data = np.asarray(delay_pxl_data[in_range])
+    x, y = data[:,0], data[:,1]
+
+    if robust:
+        fit, weights, n_iter = robust_polyfit(x, y, order)
+        print "robust fit: %d passes, %d events down-weighted to < 0.5" \
+              % (n_iter, np.sum(weights < 0.5))
+    else:
+        fit = np.polyfit(x, y, order)
+        weights = None
+
+    if n_bootstrap > 0:
+        interval, _ = bootstrap_polyfit(x, y, order, weights=weights, n_boot=n_bootstrap)
+    else:
+        interval = None
+
+    r_sq, rmes = fit_errors(x, y, np.poly1d(fit)(x), 50)
+
+    results = { 'fit'      : fit,
+                'interval' : interval,
+                'r_sq'     : r_sq,
+                'rmes'     : rmes,
+                'x_range'  : (x.min(), x.max()),
+                'n_events' : x.shape[0],
+                'data'     : data }
+
+    return results
+
+
+def report_calibration(base_path, results, metadata, n_bootstrap=0, show=False):
+    """
+    Print the fit results and write the PNG/JSON report (see
+    `write_report`).
+    """
+
+    fit = results['fit']
+    px_cutoffs = tuple(metadata['px_cutoffs'])
+    p = np.poly1d(fit)
+
+    # from docs >> fs_result = a + b*x + c*x^2, x is edge position
+    names = 'abcdefghij'[:len(fit)]
+    coeffs = fit[::-1] * 1000.0
+    if results['interval'] is not None:
+        intervals = results['interval'][:,::-1].T * 1000.0
 
     print "\nFIT RESULTS"
-    print "ps_result = a + b*x + c*x^2,  x is edge position"
+    print "ps_result = " + " + ".join([ '%s*x^%d' % (n, k) for k, n in enumerate(names) ]) \
+          + ",  x is edge position"
     print "------------------------------------------------"
-    print "a = %.12f" % a
-    print "b = %.12f" % b
-    print "c = %.12f" % c
-    print "R^2 = %f" % r_sq
+    for n, v in zip(names, coeffs):
+        print "%s = %.12f" % (n, v)
+    if results['interval'] is not None:
+        print "------------------------------------------------"
+        print "95%% confidence intervals (%d bootstrap resamples)" % n_bootstrap
+        for n, ci in zip(names, intervals):
+            print "%s : %.12f <> %.12f" % (n, ci[0], ci[1])
+        print "------------------------------------------------"
+    print "R^2 = %f" % results['r_sq']
     print "------------------------------------------------"
     print "fit range (tt pixels): %d <> %d" % px_cutoffs
     print "time range (ps):       %f <> %f" % ( p(px_cutoffs[0]), 
                                                 p(px_cutoffs[1]) )
     print "------------------------------------------------"
 
+    summary = dict(metadata)
+    # stored JSON-encoded to fit in an HDF5 attribute, see analyze_calibration_run
+    if isinstance(summary.get('cut_counts'), (str, type(u''))):
+        summary['cut_counts'] = json.loads(summary['cut_counts'])
+    summary.update({ 'n_fit_events'  : int(results['n_events']),
+                     'fit'           : [ float(v) for v in fit ],
+                     'r_sq'          : float(results['r_sq']),
+                     'rmse_per_bin'  : results['rmes'].tolist() })
+    for n, v in zip(names, coeffs):
+        summary[n] = float(v)
+    if results['interval'] is not None:
+        summary['ci95'] = dict([ (n, ci.tolist()) for n, ci in zip(names, intervals) ])
+
+    png_path, json_path = write_report(base_path, summary, fit, results['rmes'],
+                                       results['x_range'], metadata['las_delay_pv'],
+                                       delay_pxl_data=results['data'])
+    print "report --> %s, %s" % (png_path, json_path)
+
+    if show:
+        from matplotlib import pyplot as plt
+        fig = plt.figure()
+        plot_calibration(fig.add_subplot(111), fit, results['rmes'], results['x_range'],
+                         metadata['las_delay_pv'], delay_pxl_data=results['data'])
+        plt.show()
+
+    return summary
+
+
+def tt_calib_source(tt_edge_pvname):
+    """
+    The calib store source name for a timetool, from its edge PV
+    (e.g. CXI:TTSPEC:FLTPOS --> CXI:TTSPEC).
+    """
+    return tt_edge_pvname.rsplit(':', 1)[0]
+
+
+# in-process cache of calibrations read from the store
+# (calib_dir, detector_src, run) --> dict
+_CALIB_CACHE = {}
+
+
+def save_calibration(env, summary, detector_src, start, end='end'):
+    """
+    Write a timetool calibration into the psconst calib store, as
+    <calib dir>/timetool/<detector_src>/<start>-<end>.h5
+
+    Parameters
+    ----------
+    env : psana env or str
+        The psana environment, or the calib directory.
+    summary : dict
+        The fit results, as returned by `report_calibration`.
+    detector_src : str
+        The timetool source name, see `tt_calib_source`.
+    start, end : int
+        The run range the calibration is valid for, `end` can be 'end'.
+
+    Returns
+    -------
+    path : str
+        The calib file written.
+    """
+
+    calib = { 'fit_coeff'     : np.array(summary['fit'], dtype=np.float64),
+              'order'         : int(len(summary['fit']) - 1),
+              'delay_units'   : 'ns',
+              'first_run'     : int(start),
+              'last_run'      : str(end),
+              'r_sq'          : float(summary['r_sq']),
+              'rmse_per_bin'  : np.array(summary['rmse_per_bin'], dtype=np.float64),
+              'n_fit_events'  : int(summary['n_fit_events']),
+              'exp'           : str(summary['exp']),
+              'run'           : int(summary['run']),
+              'las_delay_pv'  : str(summary['las_delay_pv']),
+              'px_cutoffs'    : np.array(summary['px_cutoffs'], dtype=np.float64),
+              'fwhm_range'    : np.array(summary['fwhm_range'], dtype=np.float64),
+              'min_amplitude' : float(summary['min_amplitude']) }
+
+    path = psconst.calib_path(env, CALIB_TYPE, detector_src, start, end=end)
+    psconst.save(path, calib)
+
+    # runs already looked up may now resolve to this calibration
+    calib_dir = psconst.calib_dir(env)
+    stale = [ key for key in _CALIB_CACHE if key[:2] == (calib_dir, detector_src) ]
+    for key in stale:
+        del _CALIB_CACHE[key]
+
+    return path
+
+
+def load_calibration(env, detector_src, run):
+    """
+    Read the timetool calibration valid for `run` from the psconst calib
+    store. Results are cached by (calib dir, detector, run).
+
+    Parameters
+    ----------
+    env : psana env or str
+        The psana environment, or the calib directory.
+    detector_src : str
+        The timetool source name, see `tt_calib_source`.
+    run : int
+        The run number.
+
+    Returns
+    -------
+    calib : dict
+        See `save_calibration`, 'fit_coeff' are the np.polyfit coefficients
+        (highest power first) of the delay (ns, 'delay_units') vs. the edge
+        position. Timescaner only takes fits of order <= 2, see
+        base.tt_fit_coeffs.
+    """
+
+    key = (psconst.calib_dir(env), detector_src, run)
+    if key not in _CALIB_CACHE:
+        path = psconst.find_calib_file(env, CALIB_TYPE, detector_src, run)
+        with psconst.load(path) as c:
+            calib = c.to_dict(mmap=False)
+        calib['path'] = path
+        _CALIB_CACHE[key] = calib
+
+    return _CALIB_CACHE[key]
+
+
+def analyze_calibration_run(exp, run, las_delay_pvname, px_cutoffs=(200, 800),
+                            comm=None, robust=True, n_bootstrap=200, show=False,
+                            order=2, push=True):
+    """
+    Analyze a run where the timetool camera is fixed but the laser delay
+    changes by a known amount in order to calibrate the TT camera pixel-
+    time conversion.
+
+    The events passing the timetool quality cuts are saved (whatever their
+    edge position) to ~/tt_calib_data_<exp>_r<run>.h5, see `refit` to
+    redo the fit from that file. The results are written (headless) to a
+    PNG and JSON report next to it. If `show`, the plot is also shown
+    interactively.
+
+    If `robust`, the fit is done by `robust_polyfit` (Tukey biweight IRLS)
+    and `n_bootstrap` resamples give 95% confidence intervals on the
+    coefficients.
+
+    If `push`, the fit is saved to the psconst calib store (see
+    `save_calibration`), valid from this run on.
+
+    If an MPI communicator `comm` is passed, the events are split between
+    its ranks. Each rank only accumulates the sums needed for a plain
+    least-squares fit (`PolyfitMoments`), rank 0 reduces them, solves and
+    reports. The raw (edge, delay) pairs are then not kept or saved.
+    """
+
+    import psana
+    ds = psana.DataSource('exp=%s:run=%d:smd' % (exp, run))
+
+
+    las_dly = psana.Detector(las_delay_pvname, ds.env())
+
+    if exp[:3] == 'cxi':
+        tt_pvs = ('CXI:TTSPEC:FLTPOS', 'CXI:TTSPEC:AMPL', 'CXI:TTSPEC:FLTPOSFWHM')
+    elif exp[:3] == 'xpp':
+        tt_pvs = ('XPP:TIMETOOL:FLTPOS', 'XPP:TIMETOOL:AMPL', 'XPP:TIMETOOL:FLTPOSFWHM')
+    tt_edge, tt_famp, tt_fwhm = [ psana.Detector(pv, ds.env()) for pv in tt_pvs ]
+
+    # each detector value is read once per event, the cuts are then
+    # applied to whole blocks of events
+    raw = ColumnBuffer(4) # edge, amp, fwhm, delay
+    delay_pxl = ColumnBuffer(2, capacity=4 * BLOCK_SIZE)
+    moments = PolyfitMoments(order=order, x_range=px_cutoffs, bin_size=50)
+    cut_counts = {}
+    no_edge_cut = (-np.inf, np.inf)
+
+    if comm is None:
+        rank, size = 0, 1
+    else:
+        rank, size = comm.Get_rank(), comm.Get_size()
+
+    def process_block():
+        block = raw.data
+        accepted = apply_cuts(block[:,0], block[:,1], block[:,2], px_cutoffs,
+                              delay=block[:,3], counts=cut_counts)
+        if comm is None:
+            good = apply_cuts(block[:,0], block[:,1], block[:,2], no_edge_cut,
+                              delay=block[:,3])
+            delay_pxl.extend(block[good][:,[0,3]])
+        else:
+            moments.update(block[accepted][:,0], block[accepted][:,3])
+        raw.clear()
+        return
+
+    for i,evt in enumerate(ds.events()):
+        if i % size != rank: continue
+        raw.append(( _value(tt_edge(evt)), _value(tt_famp(evt)),
+                     _value(tt_fwhm(evt)), _value(las_dly(evt)) ))
+        if len(raw) == BLOCK_SIZE:
+            process_block()
+            if rank == 0: print "analyzed events: %d\r" % (i+1),
+    process_block()
 
-    x = np.linspace(delay_pxl_data[:,0].min(), delay_pxl_data[:,0].max(), 101)
+    if comm is not None:
+        state = comm.reduce(moments.state, root=0)
+        all_counts = comm.gather(cut_counts, root=0)
+        if rank != 0:
+            return
+        moments.state = state
+        cut_counts = dict([ (k, sum([ c[k] for c in all_counts ])) for k in cut_counts.keys() ])
 
-    # make a plot
-    plt.figure()
-    plt.plot(delay_pxl_data[:,0], delay_pxl_data[:,1], '.')
-    plt.plot(x, p(x),'r-')
-    plt.plot(rmes[:,0], rmes[:,1] - rmes[:,2]*3,'k-')
-    plt.plot(rmes[:,0], rmes[:,1] + rmes[:,2]*3,'k-')
-    plt.legend(['events', 'fit', '-3 $\sigma$', '+3 $\sigma$'])
-    plt.xlabel('Edge Position (pixels) [TTSPEC:FLTPOS]')
-    plt.ylabel('Laser Delay (ps) [%s]' % las_delay_pvname)
-    plt.xlim([0, 1024])
+    print ""
+    print "events rejected -- missing data: %d / fwhm: %d / amplitude: %d / edge: %d" \
+          % (cut_counts['missing'], cut_counts['fwhm'], cut_counts['amplitude'],
+             cut_counts['edge'])
 
-    plt.show()
+    base_path = os.path.join(os.environ['HOME'], 'tt_calib_data_%s_r%d' % (exp, run))
+    metadata = { 'exp'           : exp,
+                 'run'           : run,
+                 'las_delay_pv'  : las_delay_pvname,
+                 'tt_edge_pv'    : tt_pvs[0],
+                 'tt_amp_pv'     : tt_pvs[1],
+                 'tt_fwhm_pv'    : tt_pvs[2],
+                 'fwhm_range'    : list(FWHM_RANGE),
+                 'min_amplitude' : MIN_AMPLITUDE,
+                 'px_cutoffs'    : list(px_cutoffs),
+                 'order'         : order,
+                 'n_events'      : int(sum(cut_counts.values())),
+                 'cut_counts'    : json.dumps(cut_counts) }
+
+    if comm is None:
+
+        out_path = base_path + '.h5'
+        print "saving raw calibration data --> %s" % out_path
+        save_calibration_data(out_path, delay_pxl.data, metadata)
+
+        print "Analyzing in-range %d events" % cut_counts['accepted']
+        results = fit_calibration(delay_pxl.data, px_cutoffs, order=order,
+                                  robust=robust, n_bootstrap=n_bootstrap)
+
+    else:
+
+        n_bootstrap = 0 # needs the raw data
+        print "Analyzing in-range %d events on %d ranks" % (moments.n, size)
+
+        fit = moments.solve()
+        r_sq, rmes = moments.fit_errors(fit)
+        results = { 'fit'      : fit,
+                    'interval' : None,
+                    'r_sq'     : r_sq,
+                    'rmes'     : rmes,
+                    'x_range'  : px_cutoffs,
+                    'n_events' : moments.n,
+                    'data'     : None }
+
+    summary = report_calibration(base_path, results, metadata, n_bootstrap=n_bootstrap,
+                                 show=show)
 
 
     # push results upstream to DAQ config
 
 
     # save results to calib dir
+    if push:
+        try:
+            calib_file = save_calibration(ds.env(), summary, tt_calib_source(tt_pvs[0]), run)
+            print "calibration --> %s" % calib_file
+        except (IOError, OSError) as e:
+            print "*** WARNING: could not save calibration to calib dir: %s" % e
+
+    return
 
 
+def refit(path, px_cutoffs=None, order=None, robust=True, n_bootstrap=200,
+          show=False, calib_dir=None):
+    """
+    Redo the calibration fit from raw data saved by
+    `analyze_calibration_run`, without reading the XTC again.
 
-    return
+    Parameters
+    ----------
+    path : str
+        The tt_calib_data_<exp>_r<run>.h5 file.
+    px_cutoffs : tuple
+        The (min, max) edge position to fit. `None` uses the saved value.
+    order : int
+        The polynomial order. `None` uses the saved value.
+    robust, n_bootstrap, show
+        See `analyze_calibration_run`.
+    calib_dir : str
+        If passed, the new fit is saved to this calib store (see
+        `save_calibration`), valid from the calibration run on.
 
+    Returns
+    -------
+    summary : dict
+        The fit results (as written to the JSON report).
+    """
 
+    delay_pxl_data, metadata = load_calibration_data(path)
 
-if __name__ == '__main__':
-    analyze_calibration_run('cxii2415', 65, 'LAS:FS5:VIT:FS_TGT_TIME_DIAL', ffb=False)
-    
+    if px_cutoffs is not None:
+        metadata['px_cutoffs'] = list(px_cutoffs)
+    if order is not None:
+        metadata['order'] = order
+
+    base_path = os.path.splitext(path)[0] + '_refit'
+    results = fit_calibration(delay_pxl_data, tuple(metadata['px_cutoffs']),
+                              order=int(metadata['order']), robust=robust,
+                              n_bootstrap=n_bootstrap)
+
+    summary = report_calibration(base_path, results, metadata, n_bootstrap=n_bootstrap,
+                                 show=show)
+
+    if calib_dir is not None:
+        calib_file = save_calibration(calib_dir, summary,
+                                      tt_calib_source(metadata['tt_edge_pv']),
+                                      metadata['run'])
+        print "calibration --> %s" % calib_file
 
+    return summary
+
+
+
+if __name__ == '__main__':
+    analyze_calibration_run('cxii2415', 65, 'LAS:FS5:VIT:FS_TGT_TIME_DIAL')
@@ -0,0 +1,162 @@
+
+"""
+Distributing read-only arrays (e.g. precomputed detector constants) from
+one MPI rank to all the others.
+
+`bcast_arrays` gives every rank its own copy. `share_arrays` puts one copy
+per node in MPI shared memory (`MPI.Win.Allocate_shared`) that all ranks
+on the node map read-only.
+
+Example
+-------
+>>> arrays = ra.to_arrays() if rank == 0 else None
+>>> arrays, windows = share_arrays(comm, arrays)
+>>> ra = RadialAverager.from_arrays(arrays)
+>>> ...
+>>> free_windows(windows)  # once the arrays are no longer used
+"""
+
+import numpy as np
+from mpi4py import MPI
+
+
+def _layout(comm, arrays, root):
+    """
+    Broadcast the names, shapes and dtypes of the arrays (and the plain
+    values) in `arrays` from `root`.
+    """
+
+    if comm.Get_rank() == root:
+        layout = {}
+        for k, v in arrays.items():
+            if isinstance(v, np.ndarray):
+                layout[k] = ('array', v.shape, v.dtype.str)
+            else:
+                layout[k] = ('value', v)
+    else:
+        layout = None
+
+    return comm.bcast(layout, root=root)
+
+
+def bcast_arrays(comm, arrays, root=0):
+    """
+    Broadcast a dict of arrays (and plain values) from `root`: the layout
+    is pickled, the array data are sent as raw buffers.
+
+    Parameters
+    ----------
+    comm : mpi4py.MPI.Comm
+        The communicator.
+    arrays : dict
+        The arrays, only used on `root`.
+    root : int
+        The sending rank.
+
+    Returns
+    -------
+    arrays : dict
+        A copy of `arrays` on every rank.
+    """
+
+    layout = _layout(comm, arrays, root)
+    rank = comm.Get_rank()
+
+    result = {}
+    for k in sorted(layout.keys()):
+        if layout[k][0] == 'value':
+            result[k] = layout[k][1]
+            continue
+        if rank == root:
+            buf = np.ascontiguousarray(arrays[k])
+        else:
+            buf = np.empty(layout[k][1], dtype=layout[k][2])
+        comm.Bcast(buf, root=root)
+        result[k] = buf
+
+    return result
+
+
+def share_arrays(comm, arrays, root=0):
+    """
+    Distribute a dict of arrays (and plain values) from `root`, keeping a
+    single copy of each array per node in an MPI shared-memory window.
+
+    The first rank of each node allocates the windows, the node leaders
+    receive the data from `root`, and the other ranks attach to their
+    node's copy. All returned arrays are read-only.
+
+    Parameters
+    ----------
+    comm : mpi4py.MPI.Comm
+        The communicator, `root` must be the first of its node (as rank 0
+        always is).
+    arrays : dict
+        The arrays, only used on `root`.
+    root : int
+        The sending rank.
+
+    Returns
+    -------
+    arrays : dict
+        The shared arrays on every rank.
+    windows : list of mpi4py.MPI.Win
+        The shared-memory windows, keep them until the arrays are no longer
+        used, then release them with `free_windows`.
+    """
+
+    layout = _layout(comm, arrays, root)
+    rank = comm.Get_rank()
+
+    node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED, key=rank)
+    node_rank = node_comm.Get_rank()
+    leader = (node_rank == 0)
+    if rank == root and not leader:
+        raise ValueError('`root` must be the first rank of its node')
+
+    # node leaders, in order of their rank in `comm`: root is leader 0
+    leader_comm = comm.Split(0 if leader else MPI.UNDEFINED, key=rank)
+
+    result = {}
+    windows = []
+    for k in sorted(layout.keys()):
+
+        if layout[k][0] == 'value':
+            result[k] = layout[k][1]
+            continue
+
+        shape, dtype = layout[k][1], np.dtype(layout[k][2])
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+
+        win = MPI.Win.Allocate_shared(nbytes if leader else 0, dtype.itemsize,
+                                      comm=node_comm)
+        windows.append(win)
+        buf, itemsize = win.Shared_query(0)
+        shared = np.ndarray(shape, dtype=dtype, buffer=buf)
+
+        if leader:
+            if rank == root:
+                shared[...] = arrays[k]
+            leader_comm.Bcast(shared, root=0)
+
+        shared.flags.writeable = False
+        result[k] = shared
+
+    # nobody reads before the leaders are done writing
+    node_comm.Barrier()
+
+    if leader_comm != MPI.COMM_NULL:
+        leader_comm.Free()
+    node_comm.Free()
+
+    return result, windows
+
+
+def free_windows(windows):
+    """
+    Release the windows returned by `share_arrays` (collective over each
+    node).
+    """
+    for win in windows:
+        win.Free()
+    return
@@ -0,0 +1,177 @@
+
+"""
+Per-event radial profile output, written in parallel (MPI-IO) by all ranks
+into a single HDF5 file.
+
+The file holds an (n_events, n_bins) `profiles` dataset, the matching
+event numbers in `index` and the bin centers in `q`, so runs can be re-binned
+(e.g. by timetool delay) without a second pass over the XTC.
+"""
+
+import h5py
+import numpy as np
+
+
+class ProfileWriter(object):
+    """
+    Collective writer for blocks of per-event profiles.
+
+    Each call to `write_block` is collective: every rank writes the same
+    number of rows, `block_size`, into its own hyperslab. With chunks of
+    `block_size` rows, every rank's write lands on exactly one chunk.
+    """
+
+    def __init__(self, path, n_bins, block_size, comm=None, bin_centers=None):
+        """
+        Parameters
+        ----------
+        path : str
+            The HDF5 file to (over)write.
+        n_bins : int
+            The length of each profile.
+        block_size : int
+            The number of rows each rank writes per `write_block` call, also
+            the chunk size.
+        comm : mpi4py.MPI.Comm
+            The communicator to open the file with the MPI-IO driver on. If
+            `None` the file is written serially.
+        bin_centers : np.ndarray
+            Optional, saved as `q`.
+        """
+
+        self.n_bins = n_bins
+        self.block_size = block_size
+        self.comm = comm
+
+        if comm is None:
+            self.rank, self.size = 0, 1
+            self._f = h5py.File(path, 'w')
+        else:
+            self.rank, self.size = comm.Get_rank(), comm.Get_size()
+            self._f = h5py.File(path, 'w', driver='mpio', comm=comm)
+
+        # no compression: filters cannot be used with parallel writes
+        self._profiles = self._f.create_dataset('profiles', shape=(0, n_bins),
+                                                maxshape=(None, n_bins),
+                                                chunks=(block_size, n_bins),
+                                                dtype=np.float64)
+        self._index = self._f.create_dataset('index', shape=(0,), maxshape=(None,),
+                                             chunks=(block_size,), dtype=np.int64)
+        if bin_centers is not None:
+            self._f.create_dataset('q', data=bin_centers)
+
+        self.n_written = 0
+
+        return
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def _write(self, profiles, indices, offset, n_total, collective):
+
+        # resizing is collective, every rank passes the same shape
+        self._profiles.resize((self.n_written + n_total, self.n_bins))
+        self._index.resize((self.n_written + n_total,))
+
+        start = self.n_written + offset
+        stop  = start + profiles.shape[0]
+
+        if collective and (self.comm is not None):
+            with self._profiles.collective:
+                self._profiles[start:stop] = profiles
+            with self._index.collective:
+                self._index[start:stop] = indices
+        elif stop > start:
+            self._profiles[start:stop] = profiles
+            self._index[start:stop] = indices
+
+        self.n_written += n_total
+
+        return
+
+
+    def write_block(self, profiles, indices):
+        """
+        Collectively write one block of `block_size` profiles per rank.
+
+        Parameters
+        ----------
+        profiles : np.ndarray
+            A (block_size, n_bins) array.
+        indices : np.ndarray (int)
+            The event number of each profile.
+        """
+
+        if profiles.shape != (self.block_size, self.n_bins):
+            raise ValueError('`profiles` must have shape (%d, %d), got %s'
+                             % (self.block_size, self.n_bins, profiles.shape))
+
+        self._write(profiles, indices, self.rank * self.block_size,
+                    self.size * self.block_size, collective=True)
+
+        return
+
+
+    def write(self, profiles, indices):
+        """
+        Write any number of profiles per rank (e.g. what is left at the end
+        of a run). Still must be called by all ranks, as the offsets are
+        exchanged and the datasets resized collectively.
+
+        Parameters
+        ----------
+        profiles : np.ndarray
+            An (N, n_bins) array, N may differ between ranks.
+        indices : np.ndarray (int)
+            The event number of each profile.
+        """
+
+        n = profiles.shape[0]
+        if self.comm is None:
+            counts = [n]
+        else:
+            counts = self.comm.allgather(n)
+
+        # independent I/O: ranks with nothing to write skip the write
+        self._write(profiles, indices, sum(counts[:self.rank]), sum(counts),
+                    collective=False)
+
+        return
+
+
+    def close(self):
+        if self._f:
+            self._f.close()
+        return
+
+
+def load(path):
+    """
+    Read a profile file written by `ProfileWriter`, in file order.
+
+    The rows are in the order they were written (rank-major within each
+    block, as the small data written alongside them), so row i matches
+    record i of `smalldata.load`. Sort by `index` for event order.
+
+    Returns
+    -------
+    q : np.ndarray
+        The bin centers (`None` if not saved).
+    index : np.ndarray
+        The event numbers.
+    profiles : np.ndarray
+        The (n_events, n_bins) profiles.
+    """
+
+    with h5py.File(path, 'r') as f:
+        q = f['q'][:] if 'q' in f else None
+        index = f['index'][:]
+        profiles = f['profiles'][:]
+
+    return q, index, profiles
@@ -0,0 +1,169 @@
+
+"""
+Ordering the timepoints of a scan, and estimating what a given order costs
+in stage travel and time.
+
+A fully shuffled order (np.random.shuffle) decorrelates the timepoints
+from slow drifts, but sends the TT stage back and forth across its whole
+range on every step. The orderings here keep most of the decorrelation
+while bounding the travel:
+
+-- 'blocked' : the sorted timepoints are cut into blocks of neighbours
+               (block boundaries moved by a random offset each repeat),
+               every other block (random phase) is visited going up and the
+               rest coming back down, and the points within each block in
+               random order. Travel per repeat is at most
+               ~(2 + `block_size`^2 / n) x range.
+-- 'sweep'   : interleaved up/down sweeps: each repeat visits every
+               `block_size`-th point going up, the next comb going down,
+               and so on, with a random phase. Within each comb the points
+               are locally shuffled: none is moved more than
+               `SWEEP_JITTER` places from its place in the sweep. Travel per
+               repeat is at most ~`block_size` x (1 + `SWEEP_JITTER`) x
+               range.
+-- 'shuffle' : a full random permutation of all (repeated) timepoints.
+"""
+
+import numpy as np
+
+
+ORDERINGS = ('shuffle', 'blocked', 'sweep')
+
+SWEEP_JITTER = 2 # max displacement of a point within its sweep, see 'sweep'
+
+
+def move_duration(distance, velocity, acceleration=None):
+    """
+    The time a move of `distance` takes from rest to rest, with a
+    trapezoidal velocity profile.
+
+    Parameters
+    ----------
+    distance : float or np.ndarray
+    velocity : float
+        Max speed (units / s).
+    acceleration : float
+        Units / s^2, `None` for instant acceleration.
+    """
+
+    d = np.abs(distance)
+    v = float(velocity)
+    if acceleration is None:
+        return d / v
+    a = float(acceleration)
+    return np.where(d >= v * v / a, d / v + v / a, 2.0 * np.sqrt(d / a))
+
+
+def order_timepoints(times, repeats=1, method='blocked', block_size=None,
+                     random_state=None):
+    """
+    Order `repeats` visits of each of `times`.
+
+    Parameters
+    ----------
+    times : np.ndarray
+        The (distinct) timepoints.
+    repeats : int
+        How many times each timepoint is visited.
+    method : str
+        One of 'blocked', 'sweep', 'shuffle', see the module doc.
+    block_size : int
+        Block size ('blocked') or number of interleaved sweeps ('sweep').
+        Defaults to ~sqrt(len(times)) and 2 respectively.
+    random_state : int or np.random.RandomState
+        For reproducible orders.
+
+    Returns
+    -------
+    order : np.ndarray
+        The `repeats * len(times)` timepoints, in the order to visit them.
+    """
+
+    if method not in ORDERINGS:
+        raise ValueError('`method` must be one of %s, got %s' % (ORDERINGS, method))
+
+    if isinstance(random_state, np.random.RandomState):
+        rs = random_state
+    else:
+        rs = np.random.RandomState(random_state)
+
+    t = np.sort(np.asarray(times, dtype=np.float64))
+    n = t.shape[0]
+
+    if method == 'shuffle':
+        return rs.permutation(np.tile(t, repeats))
+
+    out = []
+    for r in range(repeats):
+
+        if method == 'blocked':
+            size = int(round(np.sqrt(n))) if block_size is None else int(block_size)
+            size = min(max(size, 1), max(n, 1))
+            offset = rs.randint(size)
+            bounds = [0] + list(range(offset if offset > 0 else size, n, size)) + [n]
+            blocks = [ t[a:b] for a, b in zip(bounds[:-1], bounds[1:]) if b > a ]
+            # every other block on the way up, the rest on the way down: a
+            # single repeat is then no monotone sweep, and ends where the
+            # next one starts
+            phase = rs.randint(2)
+            blocks = blocks[phase::2] + blocks[1 - phase::2][::-1]
+            for block in blocks:
+                out.extend(rs.permutation(block))
+
+        elif method == 'sweep':
+            n_sweeps = 2 if block_size is None else max(int(block_size), 1)
+            phase = rs.randint(n_sweeps)
+            combs = [ t[(phase + k) % n_sweeps::n_sweeps] for k in range(n_sweeps) ]
+            # start each repeat from the end the last one finished at
+            up = (r * n_sweeps) % 2 == 0
+            for comb in combs:
+                comb = comb if up else comb[::-1]
+                jitter = np.arange(comb.shape[0]) + rs.uniform(0.0, SWEEP_JITTER + 1,
+                                                               comb.shape[0])
+                out.extend(comb[np.argsort(jitter, kind='mergesort')])
+                up = not up
+
+    return np.array(out)
+
+
+def estimate_scan(positions, nevents_per_timestep, event_rate, velocity,
+                  acceleration=None, start=None, overhead=0.0):
+    """
+    Estimate the stage travel and time a scan will take.
+
+    Parameters
+    ----------
+    positions : np.ndarray
+        The stage position at each step, in order.
+    nevents_per_timestep : int
+        Events taken at each step.
+    event_rate : float
+        The DAQ event rate, Hz.
+    velocity, acceleration : float
+        The stage max velocity and acceleration, see `move_duration`.
+    start : float
+        The stage position before the scan, default the first step.
+    overhead : float
+        Any fixed time per step (s), e.g. DAQ transitions.
+
+    Returns
+    -------
+    estimate : dict
+        'travel' (total distance), 'move_time', 'acquire_time' and
+        'total_time' (s).
+    """
+
+    positions = np.asarray(positions, dtype=np.float64)
+    if start is None:
+        start = positions[0] if positions.shape[0] > 0 else 0.0
+    steps = np.diff(np.concatenate([[start], positions]))
+
+    move_time = float(np.sum(move_duration(steps, velocity, acceleration)))
+    acquire_time = positions.shape[0] * nevents_per_timestep / float(event_rate)
+
+    estimate = { 'travel'       : float(np.sum(np.abs(steps))),
+                 'move_time'    : move_time,
+                 'acquire_time' : acquire_time,
+                 'total_time'   : move_time + acquire_time + positions.shape[0] * overhead }
+
+    return estimate
@@ -0,0 +1,353 @@
+
+"""
+An in-process stand-in for the EPICS PVs and the DAQ a Timescaner drives,
+to develop and benchmark scan logic (scheduling, settle detection, dead
+time) without beamtime.
+
+Motors move with a trapezoidal velocity profile (max velocity and
+acceleration). As for an EPICS motor record, the motor PV is the setpoint
+and <motor>.RBV the readback, which follows the move -- with optional
+noise -- firing monitor callbacks as it goes. <motor>.VELO and .ACCL give
+the speed and the time to reach it. The DAQ takes `events` shots per calib cycle
+at a fixed event rate, each begin/end transition takes `transition_time`.
+Everything can run faster than real time (`time_scale`), all times
+reported are in simulated seconds.
+
+Example
+-------
+>>> sim = SimBackend(time_scale=10.0)
+>>> sim.add_motor('CXI:LAS:MMN:04', velocity=2.0, acceleration=10.0, noise=1.0e-4)
+>>> tt = Timescaner('cxi-daq', 4, 'LAS:FS5:VIT:FS_TGT_TIME_DIAL', 'CXI:LAS:MMN:04',
+>>>                 'LAS:FS5:VIT:FS_TGT_TIME_OFFSET', 'LAS:FS5:VIT:PHASE_LOCKED',
+>>>                 backend=sim)   # watches CXI:LAS:MMN:04.RBV
+>>> tt.scan_times([-0.001, 0.0, 0.001], nevents_per_timestep=120)
+>>> print sim.daq_instance.acquire_time, sim.now()
+"""
+
+import time
+import threading
+
+import numpy as np
+
+from timescans import scheduling
+
+
+class SimClock(object):
+    """
+    Simulated time, running `time_scale` times faster than the wall clock.
+    """
+
+    def __init__(self, time_scale=1.0):
+        self.time_scale = float(time_scale)
+        self._t0 = time.time()
+
+    def now(self):
+        return (time.time() - self._t0) * self.time_scale
+
+    def sleep(self, seconds):
+        if seconds > 0.0:
+            time.sleep(seconds / self.time_scale)
+        return
+
+
+class SimPV(object):
+    """
+    A PV whose value is set immediately by `put` (e.g. a setpoint or a
+    status PV). Implements the parts of the epics.PV interface Timescaner
+    uses.
+    """
+
+    def __init__(self, pvname, value=0.0, clock=None):
+        self.pvname = pvname
+        self.connected = True
+        self.clock = SimClock() if clock is None else clock
+        self._value = value
+        self._callbacks = {}
+        self._next_index = 0
+        self._lock = threading.Lock()
+
+    @property
+    def value(self):
+        return self._value
+
+    def get(self):
+        return self._value
+
+    def put(self, value, wait=False):
+        self._set(value)
+        return
+
+    def _set(self, value):
+        self._value = value
+        with self._lock:
+            callbacks = list(self._callbacks.values())
+        for cb in callbacks:
+            cb(pvname=self.pvname, value=value)
+        return
+
+    def add_callback(self, callback):
+        with self._lock:
+            self._next_index += 1
+            self._callbacks[self._next_index] = callback
+            return self._next_index
+
+    def remove_callback(self, index):
+        with self._lock:
+            self._callbacks.pop(index, None)
+        return
+
+
+class SimMotor(SimPV):
+    """
+    A motor record: the PV itself is the setpoint, `put` sets it and starts
+    a move to the new position, limited by `velocity` and `acceleration`.
+    The `readback` PV (<pvname>.RBV) is updated (and its monitors fired)
+    `update_rate` times per simulated second, plus gaussian `noise`.
+    `fields` holds it and the .VELO / .ACCL (acceleration time) / .RDBD
+    (retry deadband) PVs.
+    """
+
+    def __init__(self, pvname, value=0.0, velocity=1.0, acceleration=None,
+                 noise=0.0, deadband=0.0, update_rate=100.0, clock=None, seed=None):
+        """
+        Parameters
+        ----------
+        pvname : str
+        value : float
+            Initial position.
+        velocity : float
+            Max speed, units / s.
+        acceleration : float
+            Units / s^2, `None` for instant acceleration.
+        noise : float
+            Standard deviation of the readback noise.
+        deadband : float
+            The retry deadband (.RDBD). Moves stop at a random point within
+            it of the target, as a real motor record may.
+        update_rate : float
+            Readback updates per (simulated) second.
+        clock : SimClock
+        seed : int
+            For the readback noise.
+        """
+
+        SimPV.__init__(self, pvname, value=value, clock=clock)
+        self.readback = SimPV(pvname + '.RBV', value=value, clock=self.clock)
+        accl = 0.0 if acceleration is None else float(velocity) / acceleration
+        self.fields = { '.RBV'  : self.readback,
+                        '.VELO' : SimPV(pvname + '.VELO', value=float(velocity), clock=self.clock),
+                        '.ACCL' : SimPV(pvname + '.ACCL', value=accl, clock=self.clock),
+                        '.RDBD' : SimPV(pvname + '.RDBD', value=float(deadband), clock=self.clock) }
+        self.velocity = float(velocity)
+        self.acceleration = acceleration
+        self.noise = noise
+        self.deadband = float(deadband)
+        self.update_rate = update_rate
+        self.position = value
+        self.travel = 0.0       # total distance moved
+        self.move_time = 0.0    # total (simulated) time spent moving
+        self._random = np.random.RandomState(seed)
+        self._move_id = 0
+
+    def move_duration(self, distance):
+        """
+        The time (s) a move of `distance` takes, from rest to rest.
+        """
+        return float(scheduling.move_duration(distance, self.velocity, self.acceleration))
+
+    def _position_at(self, start, distance, t):
+        """ position `t` seconds into a move of `distance` from `start` """
+        d, v, a = abs(distance), self.velocity, self.acceleration
+        sign = 1.0 if distance >= 0 else -1.0
+        T = self.move_duration(distance)
+        if t >= T:
+            return start + distance
+        if a is None:
+            return start + sign * v * t
+        v_peak = min(v, np.sqrt(d * a))
+        t_acc = v_peak / a
+        if t < t_acc:
+            x = 0.5 * a * t * t
+        elif t < T - t_acc:
+            x = 0.5 * a * t_acc * t_acc + v_peak * (t - t_acc)
+        else:
+            x = d - 0.5 * a * (T - t) ** 2
+        return start + sign * x
+
+    def _readback(self):
+        if self.noise > 0.0:
+            return self.position + self._random.normal(0.0, self.noise)
+        return self.position
+
+    def put(self, value, wait=False):
+        self._set(value)
+
+        # a new put interrupts the current move (which stops where it is)
+        self._move_id += 1
+        move_id = self._move_id
+        target = value
+        if self.deadband > 0.0:
+            target += self._random.uniform(-self.deadband, self.deadband)
+        start, distance = self.position, target - self.position
+        duration = self.move_duration(distance)
+
+        def run():
+            t0 = self.clock.now()
+            dt = 1.0 / self.update_rate
+            while self._move_id == move_id:
+                t = min(self.clock.now() - t0, duration)
+                self.position = self._position_at(start, distance, t)
+                self.readback._set(self._readback())
+                if t >= duration:
+                    break
+                self.clock.sleep(min(dt, duration - t))
+            self.travel += abs(self.position - start)
+            self.move_time += min(self.clock.now() - t0, duration)
+            return
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        if wait:
+            thread.join()
+
+        return
+
+
+class SimDAQ(object):
+    """
+    Implements the parts of the pydaq.Control interface Timescaner uses:
+    each calib cycle (`begin` ... `end`) takes `events` shots at
+    `event_rate` Hz, `eventnum()` counts them as they come in.
+    """
+
+    def __init__(self, event_rate=120.0, transition_time=0.0, clock=None,
+                 first_run=1):
+        self.event_rate = float(event_rate)
+        self.transition_time = transition_time # s for each begin/end transition
+        self.clock = SimClock() if clock is None else clock
+        self.config = {}
+        self.cycles = []           # (controls, start, end) of each calib cycle
+        self.acquire_time = 0.0    # simulated s spent taking data
+        self._run = first_run - 1
+        self._run_events = 0       # events of the run in finished cycles
+        self._cycle = None         # (start, end, events) of the current cycle
+
+    def configure(self, record=False, events=120, controls=None, monitors=None, **kwargs):
+        self.config = dict(record=record, events=events, controls=controls,
+                           monitors=monitors, **kwargs)
+        if record:
+            self._run += 1
+        self._run_events = 0
+        return
+
+    def begin(self, events=None, controls=None, **kwargs):
+        if events is None:
+            events = self.config.get('events', 0)
+        self.clock.sleep(self.transition_time)
+        start = self.clock.now()
+        self._cycle = (start, start + events / self.event_rate, events)
+        self.cycles.append((controls, start, self._cycle[1]))
+        self.acquire_time += events / self.event_rate
+        return
+
+    def eventnum(self):
+        """ the number of events taken in this run so far """
+        if self._cycle is None:
+            return self._run_events
+        start, end, events = self._cycle
+        done = min(int((self.clock.now() - start) * self.event_rate), events)
+        return self._run_events + done
+
+    def end(self):
+        """ block until the current calib cycle has all its events, and is closed """
+        if self._cycle is not None:
+            start, end, events = self._cycle
+            self.clock.sleep(end - self.clock.now())
+            self.clock.sleep(self.transition_time)
+            self._run_events += events
+            self._cycle = None
+        return
+
+    def stop(self):
+        self._cycle = None
+        return
+
+    def runnumber(self):
+        return self._run
+
+    def disconnect(self):
+        return
+
+
+class SimBackend(object):
+    """
+    Drop-in for EpicsBackend. PVs are created on first use (plain SimPVs,
+    or SimMotors for names registered with `add_motor`, with their
+    <name>.RBV/.VELO/.ACCL/.RDBD fields) and shared by name, as channel access
+    would. Fields (<name>.FIELD) of PVs that are not motors never connect.
+    """
+
+    def __init__(self, time_scale=1.0, event_rate=120.0, transition_time=0.0,
+                 initial_values=None):
+        """
+        Parameters
+        ----------
+        time_scale : float
+            How many times faster than real time to run.
+        event_rate : float
+            The DAQ event rate, Hz.
+        transition_time : float
+            How long each DAQ begin/end (calib cycle) transition takes, s.
+        initial_values : dict
+            PV name --> initial value, default 0.0 (1 for PVs whose name
+            ends in LOCKED, so the laser looks locked).
+        """
+        self.clock = SimClock(time_scale)
+        self.event_rate = event_rate
+        self.transition_time = transition_time
+        self.initial_values = {} if initial_values is None else dict(initial_values)
+        self.pvs = {}
+        self.daq_instance = None
+        self._motors = {}
+
+    def add_motor(self, pvname, velocity=1.0, acceleration=None, noise=0.0, **kwargs):
+        """
+        Make `pvname` a SimMotor, see SimMotor for the parameters.
+        """
+        self._motors[pvname] = dict(velocity=velocity, acceleration=acceleration,
+                                    noise=noise, **kwargs)
+        return
+
+    def _initial_value(self, pvname):
+        default = 1.0 if pvname.endswith('LOCKED') else 0.0
+        return self.initial_values.get(pvname, default)
+
+    def PV(self, pvname):
+        if pvname not in self.pvs:
+            # a motor, or one of its fields (<motor>.RBV, ...)
+            motor = pvname if (pvname in self._motors) else pvname.rpartition('.')[0]
+            if (motor in self._motors) and (motor not in self.pvs):
+                m = SimMotor(motor, value=self._initial_value(motor),
+                             clock=self.clock, **self._motors[motor])
+                self.pvs[motor] = m
+                for pv in m.fields.values():
+                    self.pvs[pv.pvname] = pv
+        if pvname not in self.pvs:
+            self.pvs[pvname] = SimPV(pvname, value=self._initial_value(pvname),
+                                     clock=self.clock)
+            # only motor records have fields
+            if pvname.rpartition('.')[0]:
+                self.pvs[pvname].connected = False
+        return self.pvs[pvname]
+
+    def daq(self, daq_host, daq_platform):
+        if self.daq_instance is None:
+            self.daq_instance = SimDAQ(event_rate=self.event_rate,
+                                       transition_time=self.transition_time,
+                                       clock=self.clock)
+        return self.daq_instance
+
+    def now(self):
+        """ simulated seconds since the backend was created """
+        return self.clock.now()
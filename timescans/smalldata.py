@@ -0,0 +1,190 @@
+
+"""
+Columnar storage for per-event "small data" (timestamps, timetool values,
+EVR flags...).
+
+Each field of a structured array is written to its own fixed-dtype,
+chunked and compressed HDF5 dataset, appended to in blocks. Downstream code
+can read (slice) any column without parsing the others.
+
+Example
+-------
+>>> records = np.zeros(100, dtype=EVENT_DTYPE)
+>>> with SmallDataWriter('run0042.h5') as smd:
+>>>     smd.append(records)
+
+>>> delays = load('run0042.h5', fields=['las_stg', 'delta_t_ps'])
+"""
+
+import h5py
+import numpy as np
+
+
+EVENT_DTYPE = np.dtype([('index',        np.int64),
+                        ('fdcl',         np.int64),
+                        ('timestamp_s',  np.int64),
+                        ('timestamp_ns', np.int64),
+                        ('xray_on',      np.bool_),
+                        ('laser_on',     np.bool_),
+                        ('tt_pos',       np.float64),
+                        ('tt_amp',       np.float64),
+                        ('tt_fwhm',      np.float64),
+                        ('las_stg',      np.float64),
+                        ('delta_t_ps',   np.float64)])
+
+
+class SmallDataWriter(object):
+    """
+    Append blocks of structured per-event records to an HDF5 file, one
+    resizable dataset per field.
+    """
+
+    def __init__(self, path, dtype=EVENT_DTYPE, chunk_size=4096,
+                 compression='gzip', mode='w'):
+        """
+        Parameters
+        ----------
+        path : str
+            The HDF5 file to write.
+        dtype : np.dtype
+            A structured dtype, each field becomes a dataset.
+        chunk_size : int
+            The number of events per HDF5 chunk.
+        compression : str
+            Any h5py compression filter (or `None`).
+        mode : str
+            'w' to create/truncate `path`, 'a' to append to an existing file
+            with the same fields.
+        """
+
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self._f = h5py.File(path, mode)
+
+        for name in self.dtype.names:
+            if name in self._f:
+                if self._f[name].dtype != self.dtype[name]:
+                    raise IOError('dataset `%s` in %s has dtype %s, expected %s'
+                                  % (name, path, self._f[name].dtype, self.dtype[name]))
+            else:
+                self._f.create_dataset(name, shape=(0,), maxshape=(None,),
+                                       dtype=self.dtype[name],
+                                       chunks=(chunk_size,),
+                                       compression=compression,
+                                       shuffle=(compression is not None))
+
+        # keep the field order, datasets are listed alphabetically
+        self._f.attrs['fields'] = np.array(self.dtype.names, dtype='S')
+
+        return
+
+
+    def __len__(self):
+        return self._f[self.dtype.names[0]].shape[0]
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def append(self, records):
+        """
+        Append a block of records.
+
+        Parameters
+        ----------
+        records : np.ndarray
+            A structured array with (at least) the fields of `dtype`.
+        """
+
+        n_old = len(self)
+        n_new = n_old + records.shape[0]
+
+        for name in self.dtype.names:
+            ds = self._f[name]
+            ds.resize((n_new,))
+            ds[n_old:n_new] = records[name]
+
+        return
+
+
+    def write_array(self, name, data):
+        """
+        Write (or overwrite) a summary array next to the per-event fields,
+        e.g. run averages. It is not one of the `fields` `load` reads.
+
+        An existing dataset with the same shape and dtype is overwritten in
+        place: HDF5 does not reclaim the space of deleted datasets, so
+        recreating it on every update would grow the file without bound.
+
+        Parameters
+        ----------
+        name : str
+            The dataset name, can be a path ('group/name').
+        data : np.ndarray
+        """
+
+        data = np.asarray(data)
+        if name in self._f:
+            ds = self._f[name]
+            if (ds.shape == data.shape) and (ds.dtype == data.dtype):
+                ds[...] = data
+                return
+            del self._f[name]
+        self._f.create_dataset(name, data=data)
+
+        return
+
+
+    def flush(self):
+        self._f.flush()
+        return
+
+
+    def close(self):
+        if self._f:
+            self._f.close()
+        return
+
+
+def load(path, fields=None, start=None, stop=None):
+    """
+    Read per-event records written by `SmallDataWriter`.
+
+    Parameters
+    ----------
+    path : str
+        The HDF5 file to read.
+    fields : list of str
+        The fields to read, `None` reads all of them.
+    start, stop : int
+        Read only the records at file positions [start, stop). Records are
+        in the order they were appended, not necessarily by event number
+        (see the `index` field).
+
+    Returns
+    -------
+    records : np.ndarray
+        A structured array with the requested fields.
+    """
+
+    with h5py.File(path, 'r') as f:
+
+        if fields is None:
+            if 'fields' in f.attrs:
+                fields = [ str(name.decode('ascii')) for name in f.attrs['fields'] ]
+            else:
+                fields = [ name for name in f.keys() if isinstance(f[name], h5py.Dataset) ]
+
+        dtype = np.dtype([ (str(name), f[name].dtype) for name in fields ])
+        n_events = len(range(*slice(start, stop).indices(f[fields[0]].shape[0])))
+        records = np.zeros(n_events, dtype=dtype)
+
+        for name in fields:
+            records[name] = f[name][start:stop]
+
+    return records
@@ -21,9 +21,10 @@ class RunPlots(object):
         self.session = lgn.create_session('Run %d' % run_num)
         
 
-        self.las_diff = lgn.line(np.zeros_like(qs), index=qs,
+        self.las_diff = lgn.line([np.zeros_like(qs),]*3, index=qs,
                                  xaxis='q / A^{-1}', yaxis='Intensity',
-                                 description='Run %d laser on minus laser off' % run_num)
+                                 description='Run %d laser on minus laser off '
+                                             '(+/- standard error)' % run_num)
         self.las_on_off = lgn.line([np.zeros_like(qs),]*2, index=qs,
                                    xaxis='q / A^{-1}', yaxis='Intensity',
                                    description='Run %d laser on (purple) / off (teal)' % run_num)
@@ -35,15 +36,24 @@ class RunPlots(object):
                                   description='Histogram of time delays')
 
         self.image = None
+        self.dt_map = None
 
         return
 
 
-    def update_las_on_off(self, n_laser_on, laser_on_sum, n_laser_off, laser_off_sum):
+    def update_las_on_off(self, n_laser_on, laser_on_sum, n_laser_off, laser_off_sum,
+                          diff_err=None):
+        """
+        Show the laser on/off means and their difference, with the
+        difference +/- `diff_err` (e.g. from ProfileAccumulator.difference)
+        if given.
+        """
         self.las_on_off.update([laser_on_sum/n_laser_on, laser_off_sum/n_laser_off])
         diff = laser_on_sum / n_laser_on - laser_off_sum / n_laser_off
         #perc_diff = 2.0 * diff / (laser_on_sum / n_laser_on + laser_off_sum / n_laser_off) 
-        self.las_diff.update(diff)
+        if diff_err is None:
+            diff_err = np.zeros_like(diff)
+        self.las_diff.update([diff, diff - diff_err, diff + diff_err])
         return
 
 
@@ -53,6 +63,20 @@ class RunPlots(object):
         return
 
 
+    def update_delay_map(self, delays, diff_map):
+        """
+        Show the laser on minus laser off difference, (n_delays, n_q), as a
+        matrix. Delays without data (NaN) are shown as zero.
+        """
+        diff_map = np.nan_to_num(diff_map)
+        if self.dt_map is None:
+            self.dt_map = lgn.matrix(diff_map, row_labels=['%.2f ps' % d for d in delays],
+                                     description='Run %d I(q, dt) on minus off' % self.run_num)
+        else:
+            self.dt_map.update(diff_map)
+        return
+
+
     def update_image(self, imagedata):
         if self.image is None:
             self.image = lgn.image(imagedata)